@@ -1,12 +1,51 @@
 #! /usr/bin/env nix-shell
-#! nix-shell -i python2 -p "with python2Packages; [python pysha3 ed25519]"
+#! nix-shell -i python2 -p "with python2Packages; [python pysha3 ed25519 futures]"
 
+import functools
 import hashlib
 import ed25519
 import collections
+import struct
 
-Input = collections.namedtuple("Input", ["tx_id", "index"])
-Output = collections.namedtuple("Output", ["pub_key", "amount"])
+import instrument
+import lrucache
+import mempool
+import packedtable
+
+
+def _sha256(data):
+    return hashlib.sha256(data).digest()
+
+
+class Input(collections.namedtuple("Input", ["tx_id", "index"])):
+    # 32 byte tx_id, 4 byte index
+    FORMAT = struct.Struct(">32sI")
+
+    def serialize(self):
+        if len(self.tx_id) != 32:
+            raise ValueError("Input tx_id must have 32 bytes")
+        if not 0 <= self.index < 2 ** 32:
+            raise ValueError("Input index %d out of range" % self.index)
+        return Input.FORMAT.pack(self.tx_id, self.index)
+
+    @classmethod
+    def unpack_from(cls, buf, offset=0):
+        return Input(*Input.FORMAT.unpack_from(buf, offset))
+
+
+class Output(collections.namedtuple("Output", ["pub_key", "amount"])):
+    # 32 byte raw ed25519 public key, 8 byte amount
+    FORMAT = struct.Struct(">32sQ")
+
+    def serialize(self):
+        if not 0 <= self.amount < 2 ** 64:
+            raise ValueError("Output amount %d out of range" % self.amount)
+        return Output.FORMAT.pack(self.pub_key.to_bytes(), self.amount)
+
+    @classmethod
+    def unpack_from(cls, buf, offset=0):
+        pub_key, amount = Output.FORMAT.unpack_from(buf, offset)
+        return Output(ed25519.VerifyingKey(pub_key), amount)
 
 
 class InputReferenceError(Exception):
@@ -18,32 +57,482 @@ class BadSignatureError(Exception):
 
 
 class Transaction(collections.namedtuple("Transaction", ["inputs", "outputs"])):
-    
+    """A transaction. Treated as immutable once its tx_id has been taken.
+
+    The canonical encoding is the number of inputs and outputs as 4
+    byte integers, followed by the serialized inputs and outputs.
+    """
+    COUNTS = struct.Struct(">II")
+
+    def serialize(self):
+        try:
+            return self._bytes
+        except AttributeError:
+            pass
+        self._bytes = b"".join([Transaction.COUNTS.pack(len(self.inputs), len(self.outputs))] +
+                               [i.serialize() for i in self.inputs] +
+                               [o.serialize() for o in self.outputs])
+        return self._bytes
+
     def tx_id(self):
-        return hashlib.sha256(str(self)).digest()
+        try:
+            return self._tx_id
+        except AttributeError:
+            pass
+        self._tx_id = _sha256(self.serialize())
+        return self._tx_id
+
+    @classmethod
+    def unpack_from(cls, buf, offset=0):
+        """Decodes a transaction from buf at offset. Returns it and the offset past its end.
+
+        buf may be bytes or a memoryview. It is not copied, the tx_id
+        is hashed directly from it. Raises ValueError if buf ends
+        within the transaction.
+        """
+        start = offset
+        if offset + Transaction.COUNTS.size > len(buf):
+            raise ValueError("Transaction encoding ends within its counts")
+        n_in, n_out = Transaction.COUNTS.unpack_from(buf, offset)
+        offset += Transaction.COUNTS.size
+        if offset + n_in * Input.FORMAT.size + n_out * Output.FORMAT.size > len(buf):
+            raise ValueError("Transaction encoding ends within its inputs or outputs")
+        inputs = []
+        for i in range(n_in):
+            inputs.append(Input.unpack_from(buf, offset))
+            offset += Input.FORMAT.size
+        outputs = []
+        for i in range(n_out):
+            outputs.append(Output.unpack_from(buf, offset))
+            offset += Output.FORMAT.size
+        tx = Transaction(inputs, outputs)
+        tx._tx_id = _sha256(memoryview(buf)[start:offset])
+        return (tx, offset)
+
+    @classmethod
+    def deserialize(cls, buf):
+        tx, end = Transaction.unpack_from(buf)
+        if end != len(buf):
+            raise ValueError("%d trailing bytes after transaction" % (len(buf) - end))
+        return tx
 
     def make_witness(self, keys):
         tx_id = self.tx_id()
         return [k.sign(tx_id) for k in keys]
 
 
+class UtxoView(object):
+    """Copy-free overlay over a UTXO mapping.
+
+    Spends and creations are journaled in the view and only touch the
+    underlying mapping on commit(). Dropping the view discards them, so
+    a failed transaction costs nothing beyond its own size.
+    """
+
+    def __init__(self, base):
+        self.base = base
+        self.spent = set()
+        self.created = {}
+
+    def __contains__(self, key):
+        if key in self.created:
+            return True
+        return key not in self.spent and key in self.base
+
+    def __getitem__(self, key):
+        if key in self.created:
+            return self.created[key]
+        if key in self.spent:
+            raise KeyError(key)
+        return self.base[key]
+
+    def __setitem__(self, key, o):
+        self.created[key] = o
+
+    def update(self, items):
+        self.created.update(items)
+
+    def __delitem__(self, key):
+        if key in self.created:
+            del self.created[key]
+        elif key in self.spent or key not in self.base:
+            raise KeyError(key)
+        else:
+            self.spent.add(key)
+
+    def items(self):
+        for key, o in self.base.items():
+            if key not in self.spent and key not in self.created:
+                yield key, o
+        for item in self.created.items():
+            yield item
+
+    def commit(self):
+        """Applies the journaled spends and creations to the base mapping."""
+        for key in self.spent:
+            del self.base[key]
+        self.base.update(self.created)
+        self.spent = set()
+        self.created = {}
+
+
+class SnapshotUtxo(object):
+    """Read-only UTXO mapping on a blockstore.Snapshot.
+
+    Keys are stored as encoded Inputs, values as encoded Outputs.
+    """
+
+    def __init__(self, snapshot):
+        self.snapshot = snapshot
+
+    def __contains__(self, key):
+        return Input.FORMAT.pack(*key) in self.snapshot
+
+    def __getitem__(self, key):
+        data = self.snapshot.get(Input.FORMAT.pack(*key))
+        if data is None:
+            raise KeyError(key)
+        return Output.unpack_from(data)
+
+    def items(self):
+        for k, v in self.snapshot.items():
+            yield tuple(Input.unpack_from(k)), Output.unpack_from(v)
+
+
+class CompactUtxo(object):
+    """UTXO mapping packing encoded keys and Outputs into a packedtable.PackedTable.
+
+    Takes around 85 bytes per entry, far less than a dict of Outputs.
+    Outputs are decoded again on every lookup.
+    """
+
+    def __init__(self, capacity=0):
+        self.table = packedtable.PackedTable(Input.FORMAT.size, Output.FORMAT.size, capacity)
+
+    def __len__(self):
+        return len(self.table)
+
+    def __contains__(self, key):
+        return Input.FORMAT.pack(*key) in self.table
+
+    def __getitem__(self, key):
+        data = self.table.get(Input.FORMAT.pack(*key))
+        if data is None:
+            raise KeyError(key)
+        return Output.unpack_from(data)
+
+    def __setitem__(self, key, o):
+        self.table.put(Input.FORMAT.pack(*key), o.serialize())
+
+    def __delitem__(self, key):
+        if not self.table.remove(Input.FORMAT.pack(*key)):
+            raise KeyError(key)
+
+    def update(self, items):
+        if hasattr(items, "items"):
+            items = items.items()
+        for key, o in items:
+            self[key] = o
+
+    def items(self):
+        for k, v in self.table.items():
+            yield tuple(Input.unpack_from(k)), Output.unpack_from(v)
+
+
+# Blocks are stored as the number of transactions, followed by each
+# serialized transaction, its number of witnesses and the witnesses.
+COUNT = struct.Struct(">I")
+WITNESS_SIZE = 64
+
+
+def encode_block(txs):
+    """Encodes a list of (tx, witnesses) pairs."""
+    parts = [COUNT.pack(len(txs))]
+    for tx, witnesses in txs:
+        for w in witnesses:
+            if len(w) != WITNESS_SIZE:
+                raise ValueError("Witness must have %d bytes" % WITNESS_SIZE)
+        parts += [tx.serialize(), COUNT.pack(len(witnesses))] + list(witnesses)
+    return b"".join(parts)
+
+
+def decode_block(buf):
+    """Decodes a list of (tx, witnesses) pairs from bytes or a memoryview.
+
+    Raises ValueError unless buf holds exactly one encoded block.
+    """
+    buf = memoryview(buf)
+    if len(buf) < COUNT.size:
+        raise ValueError("Block encoding ends within its count")
+    n = COUNT.unpack_from(buf, 0)[0]
+    offset = COUNT.size
+    txs = []
+    for i in range(n):
+        tx, offset = Transaction.unpack_from(buf, offset)
+        if offset + COUNT.size > len(buf):
+            raise ValueError("Block encoding ends within a witness count")
+        n_witnesses = COUNT.unpack_from(buf, offset)[0]
+        offset += COUNT.size
+        if offset + n_witnesses * WITNESS_SIZE > len(buf):
+            raise ValueError("Block encoding ends within the witnesses")
+        witnesses = []
+        for j in range(n_witnesses):
+            witnesses.append(buf[offset:offset + WITNESS_SIZE].tobytes())
+            offset += WITNESS_SIZE
+        txs.append((tx, witnesses))
+    if offset != len(buf):
+        raise ValueError("%d trailing bytes after block" % (len(buf) - offset))
+    return txs
+
+
+# Witnesses found valid, as (raw pub_key, tx_id, witness) keys. A tx
+# seen by a mempool first is not verified again when it comes in a block.
+VERIFY_CACHE_SIZE = 2 ** 16
+verify_cache = lrucache.LRUCache(VERIFY_CACHE_SIZE)
+
+
+def verify_witness(j, o, w, tx_id):
+    """Tells whether w on input number j signs tx_id with the pub_key of output o."""
+    key = (o.pub_key.to_bytes(), tx_id, w)
+    if verify_cache.get(key):
+        return True
+    try:
+        o.pub_key.verify(w, tx_id)
+    except ed25519.BadSignatureError:
+        return False
+    verify_cache.put(key, True)
+    return True
+
+
+def verify_witnesses(jobs):
+    """Verifies a list of (raw pub_key, witness, tx_id) triples and returns a list of bools.
+
+    Only takes and returns picklable values, so that it can run in a
+    process pool.
+    """
+    results = []
+    for pub_key, w, tx_id in jobs:
+        try:
+            ed25519.VerifyingKey(pub_key).verify(w, tx_id)
+            results.append(True)
+        except ed25519.BadSignatureError:
+            results.append(False)
+    return results
+
+
+# Number of witnesses sent to a worker at once.
+VERIFY_CHUNK = 32
+
+
+def verify_parallel(executor, jobs, chunk=VERIFY_CHUNK):
+    """Runs verify_witnesses on jobs in chunks on a concurrent.futures executor.
+
+    The results are in the order of jobs. A single chunk is verified
+    right here, sending it to a worker would only add latency.
+    """
+    if len(jobs) <= chunk:
+        return verify_witnesses(jobs)
+    results = []
+    for r in executor.map(verify_witnesses, [jobs[i:i + chunk] for i in range(0, len(jobs), chunk)]):
+        results += r
+    return results
+
+
+# The outputs a block spent with their keys, and the keys it created.
+BlockUndo = collections.namedtuple("BlockUndo", ["txs", "spent", "created"])
+
+# Number of blocks disconnect_block can undo by default.
+MAX_UNDO = 100
+
+
 class Chain(object):
 
-    def __init__(self, genesis):
+    def __init__(self, genesis, store=None, executor=None, utxo=None):
+        """Starts a chain from genesis.
+
+        utxo is the empty mapping to keep the utxo set in, a dict by
+        default. A CompactUtxo takes far less memory. It is replaced
+        by the snapshot when continuing from one.
+
+        With a blockstore.BlockStore store, continues from the latest
+        snapshot in it and replays the blocks stored after that.
+        Accepted blocks are then appended to the store.
+
+        With a concurrent.futures executor, typically a
+        ProcessPoolExecutor, the witnesses of a block are verified
+        there, see verify_block.
+        """
         # Do not verify the genesis transaction
-        self.utxo = {}
-        self.add_utxo(genesis)
+        self.utxo = {} if utxo is None else utxo
+        self.store = store
+        self.executor = executor
+        self.verify_chunk = VERIFY_CHUNK
+        self.undo = collections.deque()
+        self.max_undo = MAX_UNDO
+        snapshot = None if store is None else store.latest_snapshot()
+        if snapshot is None:
+            self.add_utxo(genesis)
+            height = 0
+        else:
+            self.utxo = UtxoView(SnapshotUtxo(snapshot))
+            height = snapshot.height
+        if store is not None:
+            for payload in store.blocks(height):
+                self._process_block(decode_block(payload))
 
-    def add_utxo(self, tx):
+    def add_utxo(self, tx, utxo=None):
+        if utxo is None:
+            utxo = self.utxo
         tx_id = tx.tx_id()
         for o, idx in zip(tx.outputs, range(0, len(tx.outputs))):
-            self.utxo[(tx_id, idx)] = o
+            utxo[(tx_id, idx)] = o
 
     def process_tx(self, tx, witnesses):
+        self.process_block([(tx, witnesses)])
+
+    def process_block(self, txs, report=False):
+        """Processes an ordered list of (tx, witnesses) pairs atomically.
+
+        Transactions may spend outputs created earlier in the same
+        block. If any transaction is invalid, the utxo set is left
+        untouched. By default the first error is raised. With
+        report=True all transactions are checked and a list holding
+        None or the raised exception for each one is returned.
+
+        Accepted blocks are appended to the store, if any, and a utxo
+        snapshot is written whenever one is due.
+        """
+        outcomes = self._process_block(txs, report)
+        if self.store is not None and all(o is None for o in outcomes):
+            self.store.append(encode_block(txs))
+            if self.store.snapshot_due():
+                self.snapshot()
+        if report:
+            return outcomes
+
+    def _process_block(self, txs, report=False):
+        check_witness = None
+        if self.executor is not None:
+            check_witness = self.verify_block(txs)
+        new_utxo, outcomes = self._check_block(txs, report, check_witness)
+        if all(o is None for o in outcomes):
+            self.undo.append(BlockUndo(txs, [(key, self.utxo[key]) for key in new_utxo.spent],
+                                       list(new_utxo.created)))
+            if len(self.undo) > self.max_undo:
+                self.undo.popleft()
+            new_utxo.commit()
+        return outcomes
+
+    def disconnect_block(self):
+        """Undoes the last accepted block and returns its (tx, witnesses) pairs.
+
+        Costs O(size of the block). Only the last max_undo blocks can
+        be disconnected. The block is removed from the store, if any.
+        """
+        if not self.undo:
+            raise IndexError("No block to disconnect")
+        block = self.undo.pop()
+        for key in block.created:
+            del self.utxo[key]
+        for key, o in block.spent:
+            self.utxo[key] = o
+        if self.store is not None:
+            self.store.pop()
+        return block.txs
+
+    def _check_block(self, txs, report, check_witness=None, apply_tx=None):
+        """Applies txs to a new UtxoView with apply_tx, self.apply_tx by default. Returns it and the outcomes."""
+        if apply_tx is None:
+            apply_tx = self.apply_tx
+        new_utxo = UtxoView(self.utxo)
+        outcomes = []
+        for pos, (tx, witnesses) in enumerate(txs):
+            check = None if check_witness is None else functools.partial(check_witness, pos)
+            if not report:
+                apply_tx(new_utxo, tx, witnesses, check)
+                continue
+            # Give each tx its own view so that a failing tx does not
+            # leave partial spends behind for the following ones.
+            tx_utxo = UtxoView(new_utxo)
+            try:
+                apply_tx(tx_utxo, tx, witnesses, check)
+            except (InputReferenceError, BadSignatureError, ValueError) as e:
+                outcomes.append(e)
+                continue
+            tx_utxo.commit()
+            outcomes.append(None)
+        return new_utxo, outcomes
+
+    def verify_block(self, txs):
+        """Verifies all witnesses of txs on the executor.
+
+        First resolves the inputs and checks the amounts of all txs
+        without verifying anything, collecting the witnesses of txs
+        that pass. These are verified in parallel. Returns a
+        check_witness(pos, j, o, w, tx_id) function answering from the
+        results, to apply the block with. Processing thus raises or
+        reports the same errors in the same order as without executor.
+
+        Witnesses in verify_cache are not sent to the executor. A tx
+        may only become valid once an earlier tx in the block fails on
+        its signature, its witnesses are checked inline then.
+        """
+        jobs = {}
+
+        def collect(pos, j, o, w, tx_id):
+            if (o.pub_key.to_bytes(), tx_id, w) not in verify_cache:
+                jobs[(pos, j)] = (o.pub_key.to_bytes(), w, tx_id)
+            return True
+
+        # Bypass the tx scope, so that instrumentation counts each tx once.
+        outcomes = self._check_block(txs, True, collect, self._apply_tx)[1]
+        keys = sorted(k for k in jobs if outcomes[k[0]] is None)
+        results = dict(zip(keys, verify_parallel(self.executor, [jobs[k] for k in keys],
+                                                 self.verify_chunk)))
+        for k in keys:
+            if results[k]:
+                pub_key, w, tx_id = jobs[k]
+                verify_cache.put((pub_key, tx_id, w), True)
+
+        def check_witness(pos, j, o, w, tx_id):
+            if (pos, j) not in results or jobs[(pos, j)] != (o.pub_key.to_bytes(), w, tx_id):
+                return verify_witness(j, o, w, tx_id)
+            return results[(pos, j)]
+        return check_witness
+
+    def snapshot(self):
+        """Writes the utxo set to the store and continues on top of that snapshot."""
+        view = self.utxo
+        if isinstance(view, UtxoView) and isinstance(view.base, SnapshotUtxo):
+            # Copy the records of the previous snapshot without decoding them.
+            spent = set(Input.FORMAT.pack(*key) for key in view.spent)
+            created = dict((Input.FORMAT.pack(*key), o.serialize()) for key, o in view.created.items())
+            records = [(k, v) for k, v in view.base.snapshot.items() if k not in spent and k not in created]
+            records += created.items()
+        elif isinstance(view, CompactUtxo):
+            records = list(view.table.items())
+        else:
+            records = [(Input.FORMAT.pack(*key), o.serialize()) for key, o in view.items()]
+        snapshot = self.store.write_snapshot(Input.FORMAT.size, Output.FORMAT.size, records)
+        self.utxo = UtxoView(SnapshotUtxo(snapshot))
+
+    def apply_tx(self, new_utxo, tx, witnesses, check_witness=None):
+        """Validates tx against the UtxoView new_utxo and records its effects there.
+
+        check_witness(j, o, w, tx_id) tells whether the witness w of
+        input number j is valid for the output o it spends, and
+        defaults to verify_witness.
+        """
+        self._apply_tx(new_utxo, tx, witnesses, check_witness)
+
+    def _apply_tx(self, new_utxo, tx, witnesses, check_witness=None):
+        if check_witness is None:
+            check_witness = verify_witness
         i_amount = 0
         tx_id = tx.tx_id()
-        new_utxo = dict(self.utxo)
-        for i, w in zip(tx.inputs, witnesses):
+        if len(witnesses) != len(tx.inputs):
+            raise BadSignatureError("Expected %d witnesses, got %d" % (len(tx.inputs), len(witnesses)))
+        for j, (i, w) in enumerate(zip(tx.inputs, witnesses)):
             # Input reference unspent outputs in previous
             # transactions. They do so with a tx_id and index
             # reference.
@@ -53,11 +542,9 @@ class Chain(object):
             except KeyError:
                 raise InputReferenceError("Input %s not found in utxo set" % str(i))
 
-            try:
-                # The witness must sign this tx_id with the pubkey in
-                # the output referenced.
-                o.pub_key.verify(w, tx_id)
-            except ed25519.BadSignatureError:
+            # The witness must sign this tx_id with the pubkey in
+            # the output referenced.
+            if not check_witness(j, o, w, tx_id):
                 raise BadSignatureError("Invalid signature on input %s" % str(i))
 
             i_amount += o.amount
@@ -66,9 +553,53 @@ class Chain(object):
         if i_amount < o_amount:
             raise ValueError("output amounts %d exceed input amounts %d", o_amount, i_amount)
 
-        self.utxo = new_utxo
-        self.add_utxo(tx)
+        self.add_utxo(tx, new_utxo)
+
+
+class PoolUtxo(object):
+    """The utxo set of a chain together with the outputs created in a Mempool on it."""
+
+    def __init__(self, pool):
+        self.pool = pool
+
+    def __contains__(self, key):
+        return key in self.pool.created_by or key in self.pool.chain.utxo
+
+    def __getitem__(self, key):
+        if key in self.pool.created_by:
+            tx, witnesses = self.pool.entries[self.pool.created_by[key]].tx
+            return tx.outputs[key[1]]
+        return self.pool.chain.utxo[key]
+
+
+class Mempool(mempool.Mempool):
+    """Mempool of (tx, witnesses) pairs, keyed by tx_id."""
+
+    def describe(self, entry):
+        tx, witnesses = entry
+        tx_id = tx.tx_id()
+        return (tx_id,
+                [(i.tx_id, i.index) for i in tx.inputs],
+                [(tx_id, idx) for idx in range(len(tx.outputs))],
+                len(tx.serialize()) + WITNESS_SIZE * len(witnesses))
+
+    def validate(self, entry):
+        tx, witnesses = entry
+        utxo = PoolUtxo(self)
+        self.chain.apply_tx(UtxoView(utxo), tx, witnesses)
+        return sum(utxo[(i.tx_id, i.index)].amount for i in tx.inputs) - sum(o.amount for o in tx.outputs)
 
 
 def new_key():
     return ed25519.create_keypair()
+
+
+instrument.register_scope(Chain, "_process_block", "block")
+instrument.register_scope(Chain, "apply_tx", "tx")
+instrument.register_scope(Chain, "verify_block", "verify_block")
+instrument.register(__name__, "verify_witness", "verify")
+instrument.register(__name__, "verify_parallel", "verify", count=lambda executor, jobs, chunk=None: len(jobs))
+instrument.register(__name__, "_sha256", "hash")
+instrument.register(UtxoView, "__getitem__", "utxo_lookup")
+instrument.register(UtxoView, "commit", "utxo_commit")
+instrument.register(Chain, "snapshot", "utxo_snapshot")
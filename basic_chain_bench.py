@@ -0,0 +1,76 @@
+#! /usr/bin/env nix-shell
+#! nix-shell -i python2 -p "with python2Packages; [python ed25519 futures]"
+
+"""Measures process_tx latency against growing UTXO set sizes.
+
+Per-transaction cost should only depend on the size of the transaction,
+so the reported latencies should stay flat from 10^3 to 10^6 entries.
+
+Then measures how processing a block with many inputs scales with the
+number of workers verifying witnesses.
+"""
+
+import concurrent.futures
+import multiprocessing
+import os
+import sys
+import timeit
+
+from basic_chain import *
+
+
+def make_chain(size, priv, pub):
+    genesis = Transaction([], [Output(pub_key=pub, amount=1000)])
+    c = Chain(genesis)
+    # Fill the utxo set with unrelated outputs. They only need to be
+    # distinct keys, so skip building real transactions for them.
+    filler = Output(pub_key=pub, amount=1)
+    for i in range(size - 1):
+        c.utxo[(os.urandom(32), i)] = filler
+    return c, genesis
+
+
+def bench(size, n_txs=200):
+    priv, pub = new_key()
+    c, prev = make_chain(size, priv, pub)
+    txs = []
+    for i in range(n_txs):
+        tx = Transaction([Input(tx_id=prev.tx_id(), index=0)],
+                         [Output(pub_key=pub, amount=1000)])
+        txs.append((tx, tx.make_witness([priv])))
+        prev = tx
+
+    start = timeit.default_timer()
+    for tx, witnesses in txs:
+        c.process_tx(tx, witnesses)
+    return (timeit.default_timer() - start) / n_txs
+
+
+def bench_block(workers, n_txs=500):
+    priv, pub = new_key()
+    genesis = Transaction([], [Output(pub_key=pub, amount=1) for i in range(n_txs)])
+    block = []
+    for i in range(n_txs):
+        tx = Transaction([Input(tx_id=genesis.tx_id(), index=i)], [Output(pub_key=pub, amount=1)])
+        block.append((tx, tx.make_witness([priv])))
+    with concurrent.futures.ProcessPoolExecutor(workers) as executor:
+        c = Chain(genesis, executor=executor)
+        # Start the workers outside of the measurement.
+        list(executor.map(abs, range(workers)))
+        start = timeit.default_timer()
+        c.process_block(block)
+        return (timeit.default_timer() - start) / n_txs
+
+
+def main(argv):
+    sizes = [int(a) for a in argv[1:]] or [10 ** 3, 10 ** 4, 10 ** 5, 10 ** 6]
+    for size in sizes:
+        print("utxo=%-8d %8.1f us/tx" % (size, bench(size) * 1e6))
+    workers = 1
+    while workers <= multiprocessing.cpu_count():
+        print("workers=%-5d %8.1f us/tx" % (workers, bench_block(workers) * 1e6))
+        workers *= 2
+
+
+if __name__ == '__main__':
+    main(sys.argv)
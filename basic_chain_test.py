@@ -1,7 +1,14 @@
 #! /usr/bin/env nix-shell
-#! nix-shell -i python2 -p "with python2Packages; [python ed25519]"
+#! nix-shell -i python2 -p "with python2Packages; [python ed25519 futures]"
 
 from basic_chain import *
+import blockstore
+import hashlib
+import os
+import instrument
+import concurrent.futures
+import shutil
+import tempfile
 import unittest
 
 class TestFoo(unittest.TestCase):
@@ -87,5 +94,400 @@ class TestFoo(unittest.TestCase):
         with self.assertRaises(BadSignatureError):
             self.c.process_tx(s_to_c, s_to_c.make_witness([self.clemens_priv]))
 
+    def test_failed_tx_leaves_utxo(self):
+        """Tests that a rejected tx does not touch the utxo set."""
+        utxo = dict(self.c.utxo)
+        s_to_c = Transaction(
+            [Input(tx_id=self.genesis_tx.tx_id(), index=0)],
+            [Output(pub_key=self.satoshi_pub, amount=900),
+             Output(pub_key=self.clemens_pub, amount=1000)])
+        with self.assertRaises(ValueError):
+            self.c.process_tx(s_to_c, s_to_c.make_witness([self.satoshi_priv]))
+        self.assertEqual(self.c.utxo, utxo)
+
+    def test_block_spends_own_outputs(self):
+        s_to_c = Transaction(
+            [Input(tx_id=self.genesis_tx.tx_id(), index=0)],
+            [Output(pub_key=self.satoshi_pub, amount=900),
+             Output(pub_key=self.clemens_pub, amount=100)])
+        c_to_s = Transaction(
+            [Input(tx_id=s_to_c.tx_id(), index=1)],
+            [Output(pub_key=self.satoshi_pub, amount=100)])
+        self.c.process_block([(s_to_c, s_to_c.make_witness([self.satoshi_priv])),
+                              (c_to_s, c_to_s.make_witness([self.clemens_priv]))])
+        self.assertEqual(set(self.c.utxo), set([(s_to_c.tx_id(), 0), (c_to_s.tx_id(), 0)]))
+
+    def test_block_atomic(self):
+        utxo = dict(self.c.utxo)
+        s_to_c = Transaction(
+            [Input(tx_id=self.genesis_tx.tx_id(), index=0)],
+            [Output(pub_key=self.clemens_pub, amount=1000)])
+        bad = Transaction(
+            [Input(tx_id=s_to_c.tx_id(), index=0)],
+            [Output(pub_key=self.satoshi_pub, amount=1000)])
+        block = [(s_to_c, s_to_c.make_witness([self.satoshi_priv])),
+                 (bad, bad.make_witness([self.satoshi_priv]))]
+        with self.assertRaises(BadSignatureError):
+            self.c.process_block(block)
+        self.assertEqual(self.c.utxo, utxo)
+
+        outcomes = self.c.process_block(block, report=True)
+        self.assertEqual(outcomes[0], None)
+        self.assertTrue(isinstance(outcomes[1], BadSignatureError))
+        self.assertEqual(self.c.utxo, utxo)
+
+    def test_out_of_range(self):
+        for tx in [Transaction([Input(tx_id=self.genesis_tx.tx_id(), index=0)],
+                               [Output(pub_key=self.clemens_pub, amount=-5)]),
+                   Transaction([Input(tx_id=self.genesis_tx.tx_id(), index=2 ** 32)], []),
+                   Transaction([Input(tx_id=b"\x01", index=0)], [])]:
+            with self.assertRaises(ValueError):
+                tx.tx_id()
+            s_to_c = Transaction(
+                [Input(tx_id=self.genesis_tx.tx_id(), index=0)],
+                [Output(pub_key=self.clemens_pub, amount=1000)])
+            outcomes = self.c.process_block([(tx, []), (s_to_c, s_to_c.make_witness([self.satoshi_priv]))],
+                                            report=True)
+            self.assertTrue(isinstance(outcomes[0], ValueError))
+            self.assertEqual(outcomes[1], None)
+
+
+class SerializeTest(unittest.TestCase):
+    def setUp(self):
+        self.priv, self.pub = new_key()
+        self.tx = Transaction(
+            [Input(tx_id=b"\x01" * 32, index=3), Input(tx_id=b"\x02" * 32, index=0)],
+            [Output(pub_key=self.pub, amount=900), Output(pub_key=self.pub, amount=2 ** 40)])
+
+    def test_round_trip(self):
+        data = self.tx.serialize()
+        self.assertEqual(len(data), 8 + 2 * 36 + 2 * 40)
+        for buf in [data, memoryview(data), bytearray(data)]:
+            tx = Transaction.deserialize(buf)
+            self.assertEqual(tx.inputs, self.tx.inputs)
+            self.assertEqual([(o.pub_key.to_bytes(), o.amount) for o in tx.outputs],
+                             [(o.pub_key.to_bytes(), o.amount) for o in self.tx.outputs])
+            self.assertEqual(tx.tx_id(), self.tx.tx_id())
+            self.assertEqual(tx.serialize(), data)
+
+    def test_canonical(self):
+        """The tx_id does not depend on which key objects are used."""
+        pub = ed25519.VerifyingKey(self.pub.to_bytes())
+        tx = Transaction(list(self.tx.inputs), [Output(pub_key=pub, amount=o.amount) for o in self.tx.outputs])
+        self.assertEqual(tx.tx_id(), self.tx.tx_id())
+
+    def test_stream(self):
+        data = self.tx.serialize() + Transaction([], []).serialize()
+        tx, end = Transaction.unpack_from(data)
+        self.assertEqual(tx.tx_id(), self.tx.tx_id())
+        tx, end = Transaction.unpack_from(data, end)
+        self.assertEqual(tx, Transaction([], []))
+        self.assertEqual(end, len(data))
+        with self.assertRaises(ValueError):
+            Transaction.deserialize(data)
+
+
+class StoreTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.priv, self.pub = new_key()
+        self.genesis_tx = Transaction([], [Output(pub_key=self.pub, amount=1000)])
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def open(self):
+        store = blockstore.BlockStore(self.dir, snapshot_interval=2, sync=False)
+        return store, Chain(self.genesis_tx, store)
+
+    def utxo(self, c):
+        return sorted((key, o.pub_key.to_bytes(), o.amount) for key, o in c.utxo.items())
+
+    def test_restart(self):
+        store, c = self.open()
+        prev = self.genesis_tx
+        for i in range(5):
+            tx = Transaction([Input(tx_id=prev.tx_id(), index=0)],
+                             [Output(pub_key=self.pub, amount=999 - i), Output(pub_key=self.pub, amount=1)])
+            c.process_tx(tx, tx.make_witness([self.priv]))
+            prev = tx
+        with self.assertRaises(InputReferenceError):
+            c.process_tx(tx, tx.make_witness([self.priv]))
+        self.assertEqual(len(store), 5)
+        self.assertEqual(store.latest_snapshot().height, 4)
+        expected = self.utxo(c)
+        store.close()
+
+        store, c = self.open()
+        self.assertEqual(self.utxo(c), expected)
+        # The chain goes on from where it left off.
+        tx = Transaction([Input(tx_id=prev.tx_id(), index=1)], [Output(pub_key=self.pub, amount=1)])
+        c.process_block([(tx, tx.make_witness([self.priv]))])
+        self.assertEqual(store.latest_snapshot().height, 6)
+        expected = self.utxo(c)
+        store.close()
+
+        store, c = self.open()
+        self.assertEqual(self.utxo(c), expected)
+        store.close()
+
+        # A snapshot with a corrupt header is ignored, and all blocks are replayed.
+        with open(os.path.join(self.dir, "snapshot-%016d" % 6), "r+b") as f:
+            f.seek(9)
+            f.write(b"\xff")
+        store, c = self.open()
+        self.assertEqual(self.utxo(c), expected)
+        store.close()
+
+    def test_disconnect(self):
+        store, c = self.open()
+        expected = [self.utxo(c)]
+        prev = self.genesis_tx
+        blocks = []
+        for i in range(3):
+            tx = Transaction([Input(tx_id=prev.tx_id(), index=0)], [Output(pub_key=self.pub, amount=1000)])
+            blocks.append([(tx, tx.make_witness([self.priv]))])
+            c.process_block(blocks[-1])
+            expected.append(self.utxo(c))
+            prev = tx
+        self.assertEqual(store.latest_snapshot().height, 2)
+        self.assertEqual(c.disconnect_block(), blocks[2])
+        self.assertEqual(self.utxo(c), expected[2])
+        c.disconnect_block()
+        self.assertEqual(self.utxo(c), expected[1])
+        self.assertEqual(store.latest_snapshot(), None)
+        store.close()
+
+        store, c = self.open()
+        self.assertEqual(len(store), 1)
+        self.assertEqual(self.utxo(c), expected[1])
+        c.disconnect_block()
+        self.assertEqual(self.utxo(c), expected[0])
+        with self.assertRaises(IndexError):
+            c.disconnect_block()
+        c.process_block(blocks[0])
+        store.close()
+
+    def test_block_encoding(self):
+        tx = Transaction([Input(tx_id=self.genesis_tx.tx_id(), index=0)], [Output(pub_key=self.pub, amount=1)])
+        block = [(tx, tx.make_witness([self.priv])), (self.genesis_tx, [])]
+        decoded = decode_block(encode_block(block))
+        self.assertEqual([(t.tx_id(), w) for t, w in decoded], [(t.tx_id(), w) for t, w in block])
+        data = encode_block(block)
+        # Every truncation and trailing bytes are rejected.
+        for end in range(len(data)):
+            with self.assertRaises(ValueError):
+                decode_block(data[:end])
+        with self.assertRaises(ValueError):
+            decode_block(data + b"\x00")
+
+
+class MempoolTest(unittest.TestCase):
+    def setUp(self):
+        self.satoshi_priv, self.satoshi_pub = new_key()
+        self.clemens_priv, self.clemens_pub = new_key()
+        self.genesis_tx = Transaction([], [Output(pub_key=self.satoshi_pub, amount=1000)])
+        self.c = Chain(self.genesis_tx)
+        self.pool = Mempool(self.c)
+
+    def test_admit_and_mine(self):
+        s_to_c = Transaction(
+            [Input(tx_id=self.genesis_tx.tx_id(), index=0)],
+            [Output(pub_key=self.satoshi_pub, amount=890),
+             Output(pub_key=self.clemens_pub, amount=100)])
+        # Spends an output of s_to_c, which is only in the pool.
+        c_to_s = Transaction(
+            [Input(tx_id=s_to_c.tx_id(), index=1)],
+            [Output(pub_key=self.satoshi_pub, amount=100)])
+        self.pool.add((s_to_c, s_to_c.make_witness([self.satoshi_priv])))
+        with self.assertRaises(BadSignatureError):
+            self.pool.add((c_to_s, c_to_s.make_witness([self.satoshi_priv])))
+        self.pool.add((c_to_s, c_to_s.make_witness([self.clemens_priv])))
+        self.assertEqual(self.pool.entries[s_to_c.tx_id()].fee, 10)
+        self.assertEqual(self.pool.parents[c_to_s.tx_id()], set([s_to_c.tx_id()]))
+
+        double = Transaction(
+            [Input(tx_id=self.genesis_tx.tx_id(), index=0)],
+            [Output(pub_key=self.clemens_pub, amount=1000)])
+        with self.assertRaises(mempool.ConflictError):
+            self.pool.add((double, double.make_witness([self.satoshi_priv])))
+
+        block = self.pool.block_template()
+        self.assertEqual([tx for tx, witnesses in block], [s_to_c, c_to_s])
+        # The witnesses were verified on admission.
+        hits = verify_cache.hits
+        self.c.process_block(block)
+        self.assertEqual(verify_cache.hits, hits + 2)
+        self.pool.remove_block(block)
+        self.assertEqual(len(self.pool), 0)
+        self.assertEqual(self.pool.size, 0)
+
+    def test_missing_witness(self):
+        split = Transaction(
+            [Input(tx_id=self.genesis_tx.tx_id(), index=0)],
+            [Output(pub_key=self.satoshi_pub, amount=500),
+             Output(pub_key=self.satoshi_pub, amount=500)])
+        self.c.process_block([(split, split.make_witness([self.satoshi_priv]))])
+        both = Transaction(
+            [Input(tx_id=split.tx_id(), index=0), Input(tx_id=split.tx_id(), index=1)],
+            [Output(pub_key=self.clemens_pub, amount=1000)])
+        witnesses = both.make_witness([self.satoshi_priv, self.satoshi_priv])
+        with self.assertRaises(BadSignatureError):
+            self.pool.add((both, witnesses[:1]))
+        self.assertEqual(len(self.pool), 0)
+        with self.assertRaises(BadSignatureError):
+            self.c.process_block([(both, witnesses[:1])])
+
+
+class InstrumentTest(unittest.TestCase):
+    def test_counts(self):
+        priv, pub = new_key()
+        genesis_tx = Transaction([], [Output(pub_key=pub, amount=1000)])
+        c = Chain(genesis_tx)
+        tx = Transaction([Input(tx_id=genesis_tx.tx_id(), index=0)],
+                         [Output(pub_key=pub, amount=900), Output(pub_key=pub, amount=100)])
+        witnesses = tx.make_witness([priv])
+        sink = instrument.Aggregator()
+        instrument.enable(sink)
+        try:
+            c.process_tx(tx, witnesses)
+        finally:
+            instrument.disable()
+        self.assertEqual(sink.scopes["block"]["count"], 1)
+        tx_ops = sink.scopes["tx"]["ops"]
+        self.assertEqual(tx_ops["verify"][0], 1)
+        self.assertEqual(tx_ops["utxo_lookup"][0], 1)
+        self.assertEqual(sink.scopes["block"]["ops"]["utxo_commit"][0], 1)
+        self.assertFalse(hasattr(Chain.__dict__["apply_tx"], "__wrapped__"))
+
+
+class CompactUtxoTest(unittest.TestCase):
+    def test_mapping(self):
+        priv, pub = new_key()
+        utxo = CompactUtxo()
+        keys = [(hashlib.sha256(str(i).encode()).digest(), i) for i in range(100)]
+        utxo.update((key, Output(pub, i)) for key, i in zip(keys, range(100)))
+        del utxo[keys[3]]
+        with self.assertRaises(KeyError):
+            del utxo[keys[3]]
+        with self.assertRaises(KeyError):
+            utxo[keys[3]]
+        self.assertEqual(len(utxo), 99)
+        self.assertFalse(keys[3] in utxo)
+        self.assertEqual(utxo[keys[7]].amount, 7)
+        self.assertEqual(utxo[keys[7]].pub_key.to_bytes(), pub.to_bytes())
+        self.assertEqual(sorted(key for key, o in utxo.items()), sorted(keys[:3] + keys[4:]))
+
+    def test_chain(self):
+        priv, pub = new_key()
+        genesis_tx = Transaction([], [Output(pub_key=pub, amount=1000)])
+        c = Chain(genesis_tx, utxo=CompactUtxo())
+        tx = Transaction([Input(tx_id=genesis_tx.tx_id(), index=0)],
+                         [Output(pub_key=pub, amount=900), Output(pub_key=pub, amount=100)])
+        c.process_tx(tx, tx.make_witness([priv]))
+        with self.assertRaises(InputReferenceError):
+            c.process_tx(tx, tx.make_witness([priv]))
+        self.assertEqual(sorted(key for key, o in c.utxo.items()), [(tx.tx_id(), 0), (tx.tx_id(), 1)])
+        c.disconnect_block()
+        self.assertEqual([o.amount for key, o in c.utxo.items()], [1000])
+
+
+class ParallelTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.executor = concurrent.futures.ProcessPoolExecutor(2)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.executor.shutdown()
+
+    def setUp(self):
+        verify_cache.clear()
+        self.keys = [new_key() for i in range(4)]
+        self.genesis_tx = Transaction([], [Output(pub_key=pub, amount=100) for priv, pub in self.keys])
+
+    def chains(self):
+        parallel = Chain(self.genesis_tx, executor=self.executor)
+        parallel.verify_chunk = 1
+        return Chain(self.genesis_tx), parallel
+
+    def spend(self, index, priv, pub, amount=100):
+        tx = Transaction([Input(tx_id=self.genesis_tx.tx_id(), index=index)], [Output(pub_key=pub, amount=amount)])
+        return (tx, tx.make_witness([priv]))
+
+    def test_block(self):
+        block = [self.spend(i, priv, pub) for i, (priv, pub) in enumerate(self.keys)]
+        for c in self.chains():
+            c.process_block(block)
+            self.assertEqual(len(c.utxo), 4)
+
+    def test_same_errors(self):
+        """Tests that errors match sequential processing, input for input."""
+        (p0, k0), (p1, k1), (p2, k2), (p3, k3) = self.keys
+        block = [self.spend(0, p0, k0),
+                 # Signed with the wrong key, but spends genesis 1
+                 # before the valid spend after it.
+                 self.spend(1, p2, k1),
+                 self.spend(1, p1, k1),
+                 self.spend(2, p2, k2, amount=101),
+                 self.spend(3, p0, k3)]
+        sequential, parallel = self.chains()
+        # Nothing is in verify_cache yet, so the pool verifies all witnesses.
+        outcomes = [type(e) for e in parallel.process_block(block, report=True)]
+        expected = [type(e) for e in sequential.process_block(block, report=True)]
+        self.assertEqual(expected, [type(None), BadSignatureError, type(None), ValueError, BadSignatureError])
+        self.assertEqual(outcomes, expected)
+        self.assertEqual(str(parallel.process_block(block, report=True)[4]),
+                         str(sequential.process_block(block, report=True)[4]))
+        with self.assertRaises(BadSignatureError):
+            parallel.process_block(block)
+        self.assertEqual(len(parallel.utxo), 4)
+
+    def test_instrument(self):
+        block = [self.spend(i, priv, pub) for i, (priv, pub) in enumerate(self.keys)]
+        sequential, parallel = self.chains()
+        sink = instrument.Aggregator()
+        instrument.enable(sink)
+        try:
+            parallel.process_block(block)
+        finally:
+            instrument.disable()
+        self.assertEqual(sink.scopes["tx"]["count"], len(block))
+        self.assertEqual(sink.scopes["tx"]["ops"]["utxo_lookup"][0], len(block))
+        self.assertEqual(sink.scopes["verify_block"]["count"], 1)
+        # In report mode, lookups go through the view of the tx and then that of the block.
+        self.assertEqual(sink.scopes["verify_block"]["ops"]["utxo_lookup"][0], 2 * len(block))
+        self.assertEqual(sink.scopes["verify_block"]["ops"]["verify"][0], len(block))
+
+
+class UtxoViewTest(unittest.TestCase):
+    def test_commit(self):
+        base = {1: "a", 2: "b"}
+        v = UtxoView(base)
+        del v[1]
+        v[3] = "c"
+        self.assertFalse(1 in v)
+        self.assertEqual(v[3], "c")
+        self.assertEqual(base, {1: "a", 2: "b"})
+        v.commit()
+        self.assertEqual(base, {2: "b", 3: "c"})
+
+    def test_spend_twice(self):
+        v = UtxoView({1: "a"})
+        del v[1]
+        with self.assertRaises(KeyError):
+            v[1]
+        with self.assertRaises(KeyError):
+            del v[1]
+
+    def test_spend_created(self):
+        base = {}
+        v = UtxoView(base)
+        v[1] = "a"
+        del v[1]
+        v.commit()
+        self.assertEqual(base, {})
+
+
 if __name__ == '__main__':
     unittest.main()
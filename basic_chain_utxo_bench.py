@@ -0,0 +1,66 @@
+#! /usr/bin/env nix-shell
+#! nix-shell -i python2 -p "with python2Packages; [python ed25519]"
+
+"""Compares memory per entry and lookup latency of utxo backends.
+
+Each backend is filled in a child process, which reports how much its
+peak RSS grew. That includes the transient copies made while growing
+the arrays of a CompactUtxo, so its steady size is reported as well.
+
+  basic_chain_utxo_bench.py [size ...]
+"""
+
+import multiprocessing
+import os
+import resource
+import sys
+import timeit
+
+from basic_chain import *
+
+
+def fill(utxo, size, pub):
+    keys = []
+    for i in range(size):
+        key = (os.urandom(32), i % 4)
+        # Distinct Outputs, like in a real utxo set.
+        utxo[key] = Output(ed25519.VerifyingKey(pub.to_bytes()), i)
+        if i % (size // 1000 or 1) == 0:
+            keys.append(key)
+    return keys
+
+
+def bench(make_utxo, size, results):
+    priv, pub = new_key()
+    before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    utxo = make_utxo()
+    keys = fill(utxo, size, pub)
+    # ru_maxrss is in KB on Linux.
+    rss = (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - before) * 1024
+    n = 10000
+    lookup = timeit.timeit(lambda: [utxo[key] for key in keys], number=max(1, n // len(keys))) / n
+    table = getattr(utxo, "table", None)
+    results.put((rss, lookup, table.memory() if table is not None else None))
+
+
+BACKENDS = [("dict", dict), ("CompactUtxo", CompactUtxo)]
+
+
+def main(argv):
+    sizes = [int(a) for a in argv[1:]] or [10 ** 4, 10 ** 5, 10 ** 6]
+    for size in sizes:
+        for name, make_utxo in BACKENDS:
+            results = multiprocessing.Queue()
+            p = multiprocessing.Process(target=bench, args=(make_utxo, size, results))
+            p.start()
+            rss, lookup, steady = results.get()
+            p.join()
+            line = "utxo=%-8d %-12s %8.1f bytes/entry peak %8.2f us/lookup" % (
+                size, name, float(rss) / size, lookup * 1e6)
+            if steady is not None:
+                line += " %8.1f bytes/entry steady" % (float(steady) / size)
+            print(line)
+
+
+if __name__ == '__main__':
+    main(sys.argv)
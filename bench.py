@@ -0,0 +1,168 @@
+#! /usr/bin/env nix-shell
+#! nix-shell -i python2 -p "with python2Packages; [python ed25519]"
+
+"""Benchmarks both chains on synthetic workloads and prints the results as JSON.
+
+For every measured operation, the JSON holds the number of calls, the
+throughput in calls per second, and the mean, median, 90th and 99th
+percentile and maximum latency in seconds.
+
+The basic chain starts with --utxo outputs spread over --actors keys.
+Each transaction spends --inputs outputs of one actor and pays
+--outputs outputs to random actors.
+
+The Mimblewimble chain starts with --utxo outputs worth 1 spread over
+--actors wallets. Actors pay --inputs coins to the next one in turn.
+Coin selection decides how many inputs a payment takes, and every
+payment has a change and a receiving output.
+
+  bench.py [--chain basic|mimblewimble|all] [--utxo N] [--txs N] ... [--output FILE]
+"""
+
+import argparse
+import collections
+import cProfile
+import json
+import platform
+import random
+import sys
+import timeit
+
+
+def percentile(latencies, p):
+    """Returns the p-th percentile of the sorted list latencies, by nearest rank."""
+    return latencies[min(len(latencies) - 1, int(len(latencies) * p / 100.0))]
+
+
+class Recorder(object):
+    """Collects the latency of every call to measure(), by operation name."""
+
+    def __init__(self):
+        self.latencies = collections.defaultdict(list)
+
+    def measure(self, name, f, *args):
+        start = timeit.default_timer()
+        result = f(*args)
+        self.latencies[name].append(timeit.default_timer() - start)
+        return result
+
+    def results(self):
+        results = {}
+        for name, latencies in self.latencies.items():
+            latencies = sorted(latencies)
+            total = sum(latencies)
+            results[name] = {
+                "n": len(latencies),
+                "throughput": len(latencies) / total if total else None,
+                "mean": total / len(latencies),
+                "p50": percentile(latencies, 50),
+                "p90": percentile(latencies, 90),
+                "p99": percentile(latencies, 99),
+                "max": latencies[-1],
+            }
+        return results
+
+
+def bench_basic(args, rec):
+    import basic_chain as bc
+
+    keys = [bc.new_key() for i in range(args.actors)]
+    genesis = bc.Transaction([], [bc.Output(keys[i % args.actors][1], 2 ** 40) for i in range(args.utxo)])
+    c = bc.Chain(genesis)
+    # Unspent (key, amount) pairs of each actor, oldest first
+    owned = [collections.deque() for k in keys]
+    for idx, o in enumerate(genesis.outputs):
+        owned[idx % args.actors].append(((genesis.tx_id(), idx), o.amount))
+
+    for i in range(args.txs):
+        sender = i % args.actors
+        if len(owned[sender]) < args.inputs:
+            raise ValueError("Actor %d ran out of outputs, use a larger --utxo" % sender)
+        spent = [owned[sender].popleft() for j in range(args.inputs)]
+        total = sum(amount for key, amount in spent)
+        receivers = [random.randrange(args.actors) for j in range(args.outputs)]
+        amounts = [total // args.outputs] * args.outputs
+        amounts[0] += total % args.outputs
+        tx = bc.Transaction([bc.Input(*key) for key, amount in spent],
+                            [bc.Output(keys[r][1], a) for r, a in zip(receivers, amounts)])
+        witnesses = rec.measure("basic.make_witness", tx.make_witness, [keys[sender][0]] * args.inputs)
+        rec.measure("basic.process_tx", c.process_tx, tx, witnesses)
+        for idx, (r, a) in enumerate(zip(receivers, amounts)):
+            owned[r].append(((tx.tx_id(), idx), a))
+
+
+def bench_mimblewimble(args, rec):
+    import mimblewimble_chain as mw
+
+    genesis = mw.OwnedOutput.generate(0)
+    c = mw.Chain(genesis.blind())
+    actors = [mw.Actor([], c) for i in range(args.actors)]
+    for i, actor in enumerate(actors):
+        outputs = [mw.OwnedOutput.generate(1) for j in range(i, args.utxo, args.actors)]
+        actor.add_outputs(outputs)
+        c.utxo.update(mw.OwnedOutput.blind_many(outputs))
+
+    for i in range(args.txs):
+        o = mw.OwnedOutput.generate(random.randrange(2 ** 32))
+        rec.measure("mimblewimble.blind", o.blind)
+        k = mw.Signature.gen_private_key()
+        P = mw.OwnedOutput(0, k).blind()
+        sig = rec.measure("mimblewimble.sign", mw.Signature.sign, mw.Signature.WITNESS_MAGIC, k)
+        rec.measure("mimblewimble.verify", sig.verify, P, mw.Signature.WITNESS_MAGIC)
+
+    for i in range(args.txs):
+        sender = actors[i % args.actors]
+        receiver = actors[(i + 1) % args.actors]
+        t = rec.measure("mimblewimble.send", sender.send, args.inputs)
+        tx = rec.measure("mimblewimble.receive", receiver.receive, t)
+        rec.measure("mimblewimble.process_tx", c.process_tx, tx)
+
+    for actor in actors:
+        rec.measure("mimblewimble.coins_owned", actor.coins_owned)
+
+
+CHAINS = collections.OrderedDict([("basic", bench_basic), ("mimblewimble", bench_mimblewimble)])
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description="Benchmarks the chains and prints JSON.")
+    parser.add_argument("--chain", choices=list(CHAINS) + ["all"], default="all")
+    parser.add_argument("--utxo", type=int, default=1000, help="initial utxo set size")
+    parser.add_argument("--txs", type=int, default=100, help="transactions per chain")
+    parser.add_argument("--inputs", type=int, default=2, help="inputs, or coins paid, per transaction")
+    parser.add_argument("--outputs", type=int, default=2, help="outputs per basic transaction")
+    parser.add_argument("--actors", type=int, default=10)
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--output", help="write the JSON there instead of to stdout")
+    parser.add_argument("--profile", help="write cProfile stats of the run there")
+    return parser.parse_args(argv)
+
+
+def main(argv):
+    args = parse_args(argv[1:])
+    if args.seed is not None:
+        random.seed(args.seed)
+    rec = Recorder()
+    profile = cProfile.Profile() if args.profile else None
+    for name, bench in CHAINS.items():
+        if args.chain in (name, "all"):
+            if profile is not None:
+                profile.runcall(bench, args, rec)
+            else:
+                bench(args, rec)
+    if profile is not None:
+        profile.dump_stats(args.profile)
+
+    config = dict(vars(args))
+    del config["output"], config["profile"]
+    report = {"config": config, "python": platform.python_version(), "results": rec.results()}
+    data = json.dumps(report, indent=2, sort_keys=True, separators=(",", ": "))
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(data + "\n")
+    else:
+        print(data)
+
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,312 @@
+"""Append-only on-disk block log with memory-mapped UTXO snapshots.
+
+A store is a directory holding:
+
+  blocks.log         records of [4 byte length][4 byte crc32][payload]
+  blocks.idx         the 8 byte offset of every record in blocks.log
+  snapshot-<height>  UTXO set after the first <height> blocks
+
+Block payloads and snapshot records are opaque bytes, the chains
+define their encoding. On open, a torn or corrupt record at the end of
+the log is cut off, so a crash while appending loses at most the block
+being written.
+
+Snapshots hold fixed-size (key, value) records sorted by key after a
+small header, followed by a crc32 for every PAGE_SIZE bytes of
+records. They are written to a temporary file and renamed into place,
+and opened with mmap in O(1), lookups are binary searches. Opening only
+checks the header, whose fields have their own crc32. A snapshot with
+a bad header is renamed to snapshot-<height>.corrupt, and the chain
+then replays the blocks from the log instead. Pages are checked when
+first read, and a corrupt one raises IOError.
+"""
+
+import mmap
+import os
+import struct
+import zlib
+
+RECORD = struct.Struct(">II")
+OFFSET = struct.Struct(">Q")
+
+
+def _crc(data):
+    return zlib.crc32(data) & 0xffffffff
+
+
+class Snapshot(object):
+    """Read-only view on a snapshot file."""
+
+    # magic, height, key size, value size, record count, crc32 of the preceding fields
+    HEADER = struct.Struct(">8sQIIQI")
+    MAGIC = b"TCSNAP02"
+    # Bytes of records covered by each crc32 after the records.
+    PAGE_SIZE = 4096
+    PAGE_CRC = struct.Struct(">I")
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, "rb") as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if len(self.mm) < Snapshot.HEADER.size:
+            raise ValueError("%s is truncated" % path)
+        magic, self.height, self.key_size, self.value_size, self.count, crc = \
+            Snapshot.HEADER.unpack_from(self.mm, 0)
+        if magic != Snapshot.MAGIC:
+            raise ValueError("%s is not a snapshot" % path)
+        if _crc(self.mm[:Snapshot.HEADER.size - 4]) != crc:
+            raise ValueError("%s has a corrupt header" % path)
+        self.record_size = self.key_size + self.value_size
+        self.end = Snapshot.HEADER.size + self.count * self.record_size
+        pages = -(-self.count * self.record_size // Snapshot.PAGE_SIZE)
+        if len(self.mm) != self.end + pages * Snapshot.PAGE_CRC.size:
+            raise ValueError("%s is truncated" % path)
+        self.checked = bytearray(pages)
+
+    def __len__(self):
+        return self.count
+
+    def _check(self, start, stop):
+        """Checks the pages holding the record bytes from start to stop, unless already done."""
+        size = Snapshot.PAGE_SIZE
+        for page in range((start - Snapshot.HEADER.size) // size, (stop - 1 - Snapshot.HEADER.size) // size + 1):
+            if self.checked[page]:
+                continue
+            lo = Snapshot.HEADER.size + page * size
+            crc = Snapshot.PAGE_CRC.unpack_from(self.mm, self.end + page * Snapshot.PAGE_CRC.size)[0]
+            if _crc(self.mm[lo:min(lo + size, self.end)]) != crc:
+                raise IOError("%s is corrupt in page %d" % (self.path, page))
+            self.checked[page] = 1
+
+    def _key(self, i):
+        start = Snapshot.HEADER.size + i * self.record_size
+        self._check(start, start + self.record_size)
+        return self.mm[start:start + self.key_size]
+
+    def _value(self, i):
+        start = Snapshot.HEADER.size + i * self.record_size
+        self._check(start, start + self.record_size)
+        return self.mm[start + self.key_size:start + self.record_size]
+
+    def _find(self, key):
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._key(mid) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < self.count and self._key(lo) == key:
+            return lo
+        return None
+
+    def __contains__(self, key):
+        return self._find(key) is not None
+
+    def get(self, key, default=None):
+        i = self._find(key)
+        if i is None:
+            return default
+        return self._value(i)
+
+    def keys(self):
+        for i in range(self.count):
+            yield self._key(i)
+
+    def items(self):
+        for i in range(self.count):
+            yield self._key(i), self._value(i)
+
+    def verify(self):
+        """Checks all pages against their checksums. Reads the whole file."""
+        try:
+            if self.end > Snapshot.HEADER.size:
+                self._check(Snapshot.HEADER.size, self.end)
+        except IOError:
+            return False
+        return True
+
+    @staticmethod
+    def encode(height, key_size, value_size, records):
+        """Returns the file contents of a snapshot of the sorted (key, value) records."""
+        header = Snapshot.HEADER.pack(Snapshot.MAGIC, height, key_size, value_size, len(records), 0)
+        body = b"".join(k + v for k, v in records)
+        pages = [Snapshot.PAGE_CRC.pack(_crc(body[i:i + Snapshot.PAGE_SIZE]))
+                 for i in range(0, len(body), Snapshot.PAGE_SIZE)]
+        return b"".join([header[:-4], Snapshot.PAGE_CRC.pack(_crc(header[:-4])), body] + pages)
+
+    def close(self):
+        self.mm.close()
+
+
+class BlockStore(object):
+    """Block log and snapshots in the directory path.
+
+    A snapshot is due every snapshot_interval blocks. With sync, every
+    append and snapshot is fsync'ed before returning.
+    """
+
+    def __init__(self, path, snapshot_interval=1000, sync=True):
+        self.path = path
+        self.snapshot_interval = snapshot_interval
+        self.sync = sync
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        self.log = open(os.path.join(path, "blocks.log"), "a+b")
+        self.idx = open(os.path.join(path, "blocks.idx"), "a+b")
+        self.offsets = []
+        self._recover()
+        self._snapshot = None
+
+    def _read_record(self, offset):
+        """Returns the payload at offset, or None if it is incomplete or corrupt."""
+        self.log.seek(offset)
+        header = self.log.read(RECORD.size)
+        if len(header) < RECORD.size:
+            return None
+        length, crc = RECORD.unpack(header)
+        payload = self.log.read(length)
+        if len(payload) < length or _crc(payload) != crc:
+            return None
+        return payload
+
+    def _recover(self):
+        self.idx.seek(0)
+        data = self.idx.read()
+        self.offsets = [OFFSET.unpack_from(data, i)[0]
+                        for i in range(0, len(data) - len(data) % OFFSET.size, OFFSET.size)]
+        # Drop index entries whose records did not make it to disk.
+        while self.offsets and self._read_record(self.offsets[-1]) is None:
+            self.offsets.pop()
+        end = 0
+        if self.offsets:
+            end = self.offsets[-1] + RECORD.size + len(self._read_record(self.offsets[-1]))
+        # Index records that were written before a crash cut off their
+        # index entry, and cut off the torn rest.
+        new = []
+        while True:
+            payload = self._read_record(end)
+            if payload is None:
+                break
+            new.append(end)
+            end += RECORD.size + len(payload)
+        self.log.truncate(end)
+        self.idx.truncate(len(self.offsets) * OFFSET.size)
+        self.idx.seek(0, os.SEEK_END)
+        for offset in new:
+            self._append_offset(offset)
+        self._flush()
+
+    def _append_offset(self, offset):
+        self.offsets.append(offset)
+        self.idx.write(OFFSET.pack(offset))
+
+    def _sync_dir(self):
+        # Makes renames in the directory durable.
+        if self.sync:
+            fd = os.open(self.path, os.O_RDONLY)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+
+    def _flush(self):
+        for f in (self.log, self.idx):
+            f.flush()
+            if self.sync:
+                os.fsync(f.fileno())
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def append(self, payload):
+        """Appends a block payload. Returns the number of blocks stored."""
+        self.log.seek(0, os.SEEK_END)
+        offset = self.log.tell()
+        self.log.write(RECORD.pack(len(payload), _crc(payload)) + payload)
+        # The record must be on disk before the index points to it.
+        self._flush()
+        self._append_offset(offset)
+        self._flush()
+        return len(self.offsets)
+
+    def get(self, height):
+        """Returns the payload of block number height, counting from 0."""
+        payload = self._read_record(self.offsets[height])
+        if payload is None:
+            raise IOError("Block %d is corrupt" % height)
+        return payload
+
+    def blocks(self, start=0):
+        """Yields the payloads of the blocks from start on."""
+        for height in range(start, len(self.offsets)):
+            yield self.get(height)
+
+    def pop(self):
+        """Removes the last block. Snapshots taken after it are deleted."""
+        offset = self.offsets.pop()
+        # Snapshots go first, none may be ahead of the blocks after a crash.
+        for n in self._snapshot_names():
+            if int(n[len("snapshot-"):]) > len(self):
+                os.remove(os.path.join(self.path, n))
+        if self._snapshot is not None and self._snapshot.height > len(self):
+            # Whoever reads from it keeps its mapping open.
+            self._snapshot = None
+        self.idx.truncate(len(self.offsets) * OFFSET.size)
+        self.log.truncate(offset)
+        self._flush()
+
+    def _snapshot_names(self):
+        return sorted(n for n in os.listdir(self.path)
+                      if n.startswith("snapshot-") and n[len("snapshot-"):].isdigit())
+
+    def _open_snapshot(self, path):
+        """Opens the snapshot at path, or sets it aside and returns None if its header is corrupt."""
+        try:
+            return Snapshot(path)
+        except ValueError:
+            os.rename(path, path + ".corrupt")
+            self._sync_dir()
+            return None
+
+    def latest_snapshot(self):
+        """Returns the newest Snapshot, or None."""
+        if self._snapshot is None:
+            names = self._snapshot_names()
+            if names:
+                self._snapshot = self._open_snapshot(os.path.join(self.path, names[-1]))
+                if self._snapshot is not None and self._snapshot.height > len(self):
+                    raise IOError("Snapshot at height %d is ahead of the %d stored blocks" %
+                                  (self._snapshot.height, len(self)))
+        return self._snapshot
+
+    def snapshot_due(self):
+        snapshot = self.latest_snapshot()
+        height = 0 if snapshot is None else snapshot.height
+        return len(self) - height >= self.snapshot_interval
+
+    def write_snapshot(self, key_size, value_size, records):
+        """Writes a snapshot of (key, value) records at the current height and returns it."""
+        data = Snapshot.encode(len(self), key_size, value_size, sorted(records))
+        name = os.path.join(self.path, "snapshot-%016d" % len(self))
+        tmp = name + ".tmp"
+        with open(tmp, "wb") as f:
+            f.write(data)
+            f.flush()
+            if self.sync:
+                os.fsync(f.fileno())
+        os.rename(tmp, name)
+        self._sync_dir()
+        self._snapshot = Snapshot(name)
+        # Older snapshots are no longer needed. Whoever still reads
+        # from the previous one keeps its mapping open.
+        for n in self._snapshot_names():
+            if os.path.join(self.path, n) != name:
+                os.remove(os.path.join(self.path, n))
+        return self._snapshot
+
+    def close(self):
+        self.log.close()
+        self.idx.close()
+        if self._snapshot is not None:
+            self._snapshot.close()
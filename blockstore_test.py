@@ -0,0 +1,133 @@
+#! /usr/bin/env nix-shell
+#! nix-shell -i python2 -p "with python2Packages; [python]"
+
+from blockstore import *
+import os
+import shutil
+import tempfile
+import unittest
+
+
+class BlockStoreTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.store = BlockStore(self.dir, snapshot_interval=3, sync=False)
+
+    def tearDown(self):
+        self.store.close()
+        shutil.rmtree(self.dir)
+
+    def reopen(self):
+        self.store.close()
+        self.store = BlockStore(self.dir, snapshot_interval=3, sync=False)
+
+    def test_append(self):
+        for i in range(5):
+            self.assertEqual(self.store.append(("block %d" % i).encode()), i + 1)
+        self.reopen()
+        self.assertEqual(len(self.store), 5)
+        self.assertEqual(self.store.get(3), b"block 3")
+        self.assertEqual(list(self.store.blocks(3)), [b"block 3", b"block 4"])
+
+    def test_torn_write(self):
+        self.store.append(b"a")
+        self.store.append(b"b")
+        # A crash in the middle of writing a record.
+        with open(os.path.join(self.dir, "blocks.log"), "ab") as f:
+            f.write(RECORD.pack(10, 0) + b"xyz")
+        self.reopen()
+        self.assertEqual(list(self.store.blocks()), [b"a", b"b"])
+        self.store.append(b"c")
+        self.reopen()
+        self.assertEqual(list(self.store.blocks()), [b"a", b"b", b"c"])
+
+    def test_corrupt_record(self):
+        self.store.append(b"a")
+        self.store.append(b"bbbb")
+        self.store.close()
+        with open(os.path.join(self.dir, "blocks.log"), "r+b") as f:
+            f.seek(-2, os.SEEK_END)
+            f.write(b"xx")
+        self.reopen()
+        self.assertEqual(list(self.store.blocks()), [b"a"])
+
+    def test_lost_index(self):
+        self.store.append(b"a")
+        self.store.append(b"b")
+        self.store.close()
+        # A crash after the record, but before its index entry was written.
+        with open(os.path.join(self.dir, "blocks.idx"), "r+b") as f:
+            f.truncate(OFFSET.size + 3)
+        self.reopen()
+        self.assertEqual(list(self.store.blocks()), [b"a", b"b"])
+
+    def test_snapshot(self):
+        self.assertEqual(self.store.latest_snapshot(), None)
+        for b in [b"a", b"b", b"c"]:
+            self.store.append(b)
+        self.assertTrue(self.store.snapshot_due())
+        records = [(("%02d" % i).encode(), ("v%d" % i).encode()) for i in [5, 1, 9]]
+        self.store.write_snapshot(2, 2, records)
+        self.assertFalse(self.store.snapshot_due())
+        self.reopen()
+        snapshot = self.store.latest_snapshot()
+        self.assertEqual(snapshot.height, 3)
+        self.assertEqual(len(snapshot), 3)
+        self.assertTrue(b"05" in snapshot)
+        self.assertFalse(b"04" in snapshot)
+        self.assertEqual(snapshot.get(b"09"), b"v9")
+        self.assertEqual(list(snapshot.keys()), [b"01", b"05", b"09"])
+        self.assertTrue(snapshot.verify())
+
+        self.store.append(b"d")
+        self.store.write_snapshot(2, 0, [])
+        self.assertEqual(len([n for n in os.listdir(self.dir) if n.startswith("snapshot")]), 1)
+        self.assertEqual(len(self.store.latest_snapshot()), 0)
+
+    def test_corrupt_snapshot(self):
+        for b in [b"a", b"b", b"c"]:
+            self.store.append(b)
+        records = [(("%04d" % i).encode(), ("v%03d" % i).encode()) for i in range(1000)]
+        self.store.write_snapshot(4, 4, records)
+        self.store.close()
+        name = os.path.join(self.dir, "snapshot-%016d" % 3)
+
+        # A corrupt record is found when its page is read.
+        with open(name, "r+b") as f:
+            f.seek(Snapshot.HEADER.size + 8 * 900)
+            f.write(b"x")
+        self.reopen()
+        snapshot = self.store.latest_snapshot()
+        self.assertEqual(snapshot.get(b"0001"), b"v001")
+        with self.assertRaises(IOError):
+            snapshot.get(b"0900")
+        self.assertFalse(snapshot.verify())
+
+        # A corrupt header sets the snapshot aside, the blocks are to be
+        # replayed from the start instead.
+        self.store.close()
+        with open(name, "r+b") as f:
+            f.seek(9)
+            f.write(b"x")
+        self.reopen()
+        self.assertEqual(self.store.latest_snapshot(), None)
+        self.assertTrue(os.path.exists(name + ".corrupt"))
+        self.assertTrue(self.store.snapshot_due())
+        self.store.write_snapshot(2, 0, [])
+        self.reopen()
+        self.assertEqual(self.store.latest_snapshot().height, 3)
+
+    def test_pop(self):
+        for b in [b"a", b"b", b"c"]:
+            self.store.append(b)
+        self.store.write_snapshot(2, 0, [])
+        self.store.pop()
+        self.assertEqual(self.store.latest_snapshot(), None)
+        self.store.append(b"x")
+        self.reopen()
+        self.assertEqual(list(self.store.blocks()), [b"a", b"b", b"x"])
+        self.assertEqual(self.store.latest_snapshot(), None)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,197 @@
+"""Coin selection over owned outputs sorted by value.
+
+A strategy is a function strategy(index, n, spendable) returning a list
+of items from the ValueIndex index, worth at least n in total if
+possible. spendable(item) tells whether an item can currently be spent.
+Strategies only call it for items they consider, so that selecting k
+outputs from a large index stays close to O(k log n).
+"""
+
+import bisect
+import itertools
+import random
+
+
+class ValueIndex(object):
+    """Items kept sorted by their value."""
+
+    def __init__(self):
+        # Sorted (value, seq) keys, and the items in the same order.
+        # seq keeps equal values in insertion order.
+        self.keys = []
+        self.items = []
+        self.key = {}
+        self.seq = itertools.count()
+
+    def __len__(self):
+        return len(self.items)
+
+    def __contains__(self, item):
+        return item in self.key
+
+    def add(self, item, value):
+        if item in self.key:
+            return
+        k = (value, next(self.seq))
+        i = bisect.bisect(self.keys, k)
+        self.keys.insert(i, k)
+        self.items.insert(i, item)
+        self.key[item] = k
+
+    def update(self, pairs):
+        """Adds many (item, value) pairs with a single sort."""
+        pairs = [(item, value) for item, value in pairs if item not in self.key]
+        if len(pairs) < 16:
+            for item, value in pairs:
+                self.add(item, value)
+            return
+        for item, value in pairs:
+            self.key[item] = (value, next(self.seq))
+        merged = sorted(list(zip(self.keys, self.items)) +
+                        [(self.key[item], item) for item, value in pairs],
+                        key=lambda e: e[0])
+        self.keys = [k for k, item in merged]
+        self.items = [item for k, item in merged]
+
+    def remove(self, item):
+        i = bisect.bisect_left(self.keys, self.key.pop(item))
+        del self.keys[i]
+        del self.items[i]
+
+    def value(self, i):
+        return self.keys[i][0]
+
+    def find(self, value):
+        """Returns the position of the first item worth at least value."""
+        return bisect.bisect_left(self.keys, (value,))
+
+
+def _random_positions(size):
+    """Yields the positions 0 .. size - 1 in random order."""
+    tried = set()
+    while 2 * len(tried) < size:
+        i = random.randrange(size)
+        if i not in tried:
+            tried.add(i)
+            yield i
+    # Once half of them are drawn, shuffling the rest is cheaper than
+    # drawing until hitting an untried one.
+    rest = [i for i in range(size) if i not in tried]
+    random.shuffle(rest)
+    for i in rest:
+        yield i
+
+
+def select_random(index, n, spendable):
+    """Picks random outputs until they are worth n."""
+    selected = []
+    total = 0
+    for i in _random_positions(len(index)):
+        if total >= n:
+            break
+        if spendable(index.items[i]):
+            selected.append(index.items[i])
+            total += index.value(i)
+    return selected
+
+
+def select_largest_first(index, n, spendable):
+    """Picks the largest outputs until they are worth n. Uses the fewest inputs."""
+    selected = []
+    total = 0
+    for i in range(len(index) - 1, -1, -1):
+        if total >= n:
+            break
+        if spendable(index.items[i]):
+            selected.append(index.items[i])
+            total += index.value(i)
+    return selected
+
+
+def _smallest_covering(index, n, spendable, taken):
+    for i in range(index.find(n), len(index)):
+        if i not in taken and spendable(index.items[i]):
+            return i
+    return None
+
+
+def select_min_change(index, n, spendable):
+    """Picks the smallest output worth n, or else the largest ones and covers the rest the same way."""
+    selected = []
+    taken = set()
+    remaining = n
+    top = len(index) - 1
+    while remaining > 0:
+        i = _smallest_covering(index, remaining, spendable, taken)
+        if i is None:
+            # No single output covers the rest, take the largest one.
+            while top >= 0 and (top in taken or not spendable(index.items[top])):
+                top -= 1
+            if top < 0:
+                break
+            i = top
+        taken.add(i)
+        selected.append(index.items[i])
+        remaining -= index.value(i)
+    return selected
+
+
+# Number of outputs not worth more than n that branch and bound searches.
+BNB_CANDIDATES = 256
+BNB_MAX_TRIES = 100000
+
+
+def select_branch_and_bound(index, n, spendable):
+    """Searches for outputs worth exactly n, to avoid a change output.
+
+    Falls back to select_min_change if there is no exact match among
+    the BNB_CANDIDATES largest outputs not worth more than n.
+    """
+    if n <= 0:
+        return []
+    values = []
+    items = []
+    for i in range(index.find(n + 1) - 1, -1, -1):
+        if len(items) == BNB_CANDIDATES:
+            break
+        if spendable(index.items[i]):
+            values.append(index.value(i))
+            items.append(index.items[i])
+
+    # suffix[i] is what values[i:] are worth together.
+    suffix = [0] * (len(values) + 1)
+    for i in range(len(values) - 1, -1, -1):
+        suffix[i] = suffix[i + 1] + values[i]
+
+    tries = [0]
+    chosen = []
+
+    def search(i, total):
+        if total == n:
+            return True
+        if i == len(values) or total + suffix[i] < n or tries[0] >= BNB_MAX_TRIES:
+            return False
+        tries[0] += 1
+        if total + values[i] <= n:
+            chosen.append(i)
+            if search(i + 1, total + values[i]):
+                return True
+            chosen.pop()
+        # Leaving out values[i] and then taking an equal value would
+        # only revisit the same sums.
+        j = i + 1
+        while j < len(values) and values[j] == values[i]:
+            j += 1
+        return search(j, total)
+
+    if search(0, 0):
+        return [items[i] for i in chosen]
+    return select_min_change(index, n, spendable)
+
+
+STRATEGIES = {
+    "random": select_random,
+    "largest_first": select_largest_first,
+    "min_change": select_min_change,
+    "branch_and_bound": select_branch_and_bound,
+}
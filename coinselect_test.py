@@ -0,0 +1,72 @@
+#! /usr/bin/env nix-shell
+#! nix-shell -i python2 -p "with python2Packages; [python]"
+
+from coinselect import *
+import random
+import unittest
+
+random.seed(70)
+
+
+class ValueIndexTest(unittest.TestCase):
+    def test_sorted(self):
+        index = ValueIndex()
+        for item, value in [("a", 5), ("b", 1), ("c", 5), ("d", 3)]:
+            index.add(item, value)
+        self.assertEqual(index.items, ["b", "d", "a", "c"])
+        self.assertEqual(index.find(4), 2)
+        index.remove("a")
+        self.assertEqual(index.items, ["b", "d", "c"])
+        self.assertFalse("a" in index)
+        index.update([(i, i % 7) for i in range(20)] + [("b", 0)])
+        self.assertEqual(len(index), 23)
+        self.assertEqual(index.keys, sorted(index.keys))
+        self.assertEqual(index.items[-6:], ["c", 5, 12, 19, 6, 13])
+
+
+class StrategyTest(unittest.TestCase):
+    def setUp(self):
+        self.index = ValueIndex()
+        self.values = {}
+        for i, value in enumerate([1, 2, 5, 10, 20, 50, 100, 200]):
+            self.index.add(i, value)
+            self.values[i] = value
+        # Item 7, worth 200, is already spent.
+        self.spendable = lambda item: item != 7
+
+    def total(self, selected):
+        self.assertEqual(len(selected), len(set(selected)))
+        self.assertFalse(7 in selected)
+        return sum(self.values[i] for i in selected)
+
+    def test_enough(self):
+        for strategy in STRATEGIES.values():
+            for n in [0, 1, 7, 73, 188]:
+                self.assertTrue(self.total(strategy(self.index, n, self.spendable)) >= n)
+            self.assertTrue(self.total(strategy(self.index, 189, self.spendable)) < 189)
+
+    def test_largest_first(self):
+        self.assertEqual(select_largest_first(self.index, 120, self.spendable), [6, 5])
+
+    def test_min_change(self):
+        self.assertEqual(select_min_change(self.index, 40, self.spendable), [5])
+        self.assertEqual(sorted(select_min_change(self.index, 120, self.spendable)), [4, 6])
+
+    def test_branch_and_bound(self):
+        for n in [7, 73, 188]:
+            self.assertEqual(self.total(select_branch_and_bound(self.index, n, self.spendable)), n)
+        # No exact match for 4, falls back to the least change.
+        self.assertEqual(select_branch_and_bound(self.index, 4, self.spendable), [2])
+
+    def test_large_index(self):
+        index = ValueIndex()
+        index.update((i, random.randrange(1, 10 ** 6)) for i in range(10 ** 5))
+        spendable = lambda item: item % 3
+        for strategy in STRATEGIES.values():
+            selected = strategy(index, 10 ** 7, spendable)
+            self.assertTrue(all(spendable(i) for i in selected))
+            self.assertTrue(sum(index.key[i][0] for i in selected) >= 10 ** 7)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,195 @@
+"""Opt-in counters and timers for hot paths.
+
+Modules register() the functions and methods worth measuring as
+operations, and register_scope() those that make up a unit of work,
+such as processing a block or a transaction. Nothing is wrapped until
+enable() is called, and disable() puts the originals back, so disabled
+instrumentation costs nothing.
+
+While enabled, every call to an operation adds to its count and time
+in the innermost scope being run. When a scope ends, its operations are
+passed to the sink as record(scope, seconds, ops), with ops mapping
+operation names to [count, seconds], and added to the enclosing scope.
+Times are inclusive, an operation calling another one is charged for
+both. Operations outside of any scope are recorded as "unscoped" on
+disable(), unless capture() keeps them for charge() to add to a later
+scope. Instrumentation is not thread safe.
+"""
+
+import functools
+import json
+import os
+import sys
+import time
+import timeit
+
+# (owner, attr, name, count, scope) of the registered hooks
+_hooks = []
+# (owner, attr, original) of the wrapped hooks, in wrapping order
+_saved = []
+# ops of the scopes being run, outermost first
+_stack = []
+_sink = None
+
+
+def register(owner, attr, name, count=None):
+    """Makes calls to owner.attr count and time as operation name.
+
+    owner is a class, a module or a module name. count(*args, **kwargs)
+    returns how much a call counts, 1 by default.
+    """
+    _hooks.append((owner, attr, name, count, False))
+
+
+def register_scope(owner, attr, name):
+    """Makes each call to owner.attr a scope called name."""
+    _hooks.append((owner, attr, name, None, True))
+
+
+def enabled():
+    return _sink is not None
+
+
+def _add(ops, name, n, seconds):
+    entry = ops.get(name)
+    if entry is None:
+        entry = ops[name] = [0, 0.0]
+    entry[0] += n
+    entry[1] += seconds
+
+
+def _op(f, name, count):
+    @functools.wraps(f)
+    def wrapper(*args, **kwargs):
+        start = timeit.default_timer()
+        try:
+            return f(*args, **kwargs)
+        finally:
+            if _stack:
+                _add(_stack[-1], name, 1 if count is None else count(*args, **kwargs),
+                     timeit.default_timer() - start)
+    return wrapper
+
+
+def _scope(f, name):
+    @functools.wraps(f)
+    def wrapper(*args, **kwargs):
+        _stack.append({})
+        start = timeit.default_timer()
+        try:
+            return f(*args, **kwargs)
+        finally:
+            seconds = timeit.default_timer() - start
+            ops = _stack.pop()
+            # _stack[0] only holds the unscoped operations.
+            if len(_stack) > 1:
+                for op, (n, t) in ops.items():
+                    _add(_stack[-1], op, n, t)
+            if _sink is not None:
+                _sink.record(name, seconds, ops)
+    return wrapper
+
+
+def capture(f, *args, **kwargs):
+    """Calls f in a scope of its own. Returns its result and the ops it ran, to pass to charge()."""
+    if _sink is None:
+        return f(*args, **kwargs), None
+    _stack.append({})
+    try:
+        result = f(*args, **kwargs)
+    finally:
+        ops = _stack.pop()
+    return result, ops
+
+
+def charge(ops):
+    """Adds ops returned by capture() to the innermost scope, without adding to its time."""
+    if ops and _stack:
+        for op, (n, t) in ops.items():
+            _add(_stack[-1], op, n, t)
+
+
+def enable(sink):
+    """Wraps the registered hooks and starts passing records to sink.
+
+    Of several hooks on the same attribute, the one registered last
+    is the outermost. Hooks registered later are only wrapped by the
+    next enable().
+    """
+    global _sink
+    disable()
+    for owner, attr, name, count, scope in _hooks:
+        if isinstance(owner, str):
+            owner = sys.modules[owner]
+        original = owner.__dict__[attr]
+        f = getattr(original, "__func__", original)
+        f = _scope(f, name) if scope else _op(f, name, count)
+        if isinstance(original, (classmethod, staticmethod)):
+            f = type(original)(f)
+        setattr(owner, attr, f)
+        _saved.append((owner, attr, original))
+    _stack[:] = [{}]
+    _sink = sink
+
+
+def disable():
+    """Restores the hooks, and records the unscoped operations and closes the sink."""
+    global _sink
+    while _saved:
+        owner, attr, original = _saved.pop()
+        setattr(owner, attr, original)
+    sink, _sink = _sink, None
+    if sink is not None:
+        if _stack and _stack[0]:
+            sink.record("unscoped", 0.0, _stack[0])
+        sink.close()
+    del _stack[:]
+
+
+class Aggregator(object):
+    """Sink summing up the records of each scope name.
+
+    scopes maps scope names to {"count": n, "seconds": t, "ops": ops},
+    with ops as in the records.
+    """
+
+    def __init__(self):
+        self.scopes = {}
+
+    def record(self, scope, seconds, ops):
+        s = self.scopes.get(scope)
+        if s is None:
+            s = self.scopes[scope] = {"count": 0, "seconds": 0.0, "ops": {}}
+        s["count"] += 1
+        s["seconds"] += seconds
+        for name, (n, t) in ops.items():
+            _add(s["ops"], name, n, t)
+
+    def close(self):
+        pass
+
+
+class FileDump(Aggregator):
+    """Aggregator writing its scopes as JSON to path at most every interval seconds, and on close."""
+
+    def __init__(self, path, interval=60.0):
+        Aggregator.__init__(self)
+        self.path = path
+        self.interval = interval
+        self.last = time.time()
+
+    def record(self, scope, seconds, ops):
+        Aggregator.record(self, scope, seconds, ops)
+        if time.time() - self.last >= self.interval:
+            self.dump()
+
+    def dump(self):
+        tmp = self.path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump({"time": time.time(), "scopes": self.scopes}, f, indent=2, sort_keys=True,
+                      separators=(",", ": "))
+        os.rename(tmp, self.path)
+        self.last = time.time()
+
+    def close(self):
+        self.dump()
@@ -0,0 +1,94 @@
+#! /usr/bin/env nix-shell
+#! nix-shell -i python2 -p "with python2Packages; [python]"
+
+import instrument
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+
+class Work(object):
+    def run(self, items):
+        return [self.step(i) for i in items]
+
+    def step(self, i):
+        return Work.double(i)
+
+    @staticmethod
+    def double(i):
+        return 2 * i
+
+    def resume(self, ops):
+        instrument.charge(ops)
+
+
+instrument.register(Work, "run", "work")
+instrument.register_scope(Work, "run", "run")
+instrument.register(Work, "step", "step")
+instrument.register(Work, "double", "double", count=lambda i: i)
+instrument.register_scope(Work, "resume", "resume")
+
+
+class InstrumentTest(unittest.TestCase):
+    def tearDown(self):
+        instrument.disable()
+
+    def test_disabled(self):
+        self.assertFalse(instrument.enabled())
+        self.assertEqual(Work.__dict__["step"].__name__, "step")
+        self.assertFalse(hasattr(Work.__dict__["step"], "__wrapped__"))
+
+    def test_scopes(self):
+        sink = instrument.Aggregator()
+        instrument.enable(sink)
+        self.assertEqual(Work().run([1, 2]), [2, 4])
+        Work().run([3])
+        Work().step(5)
+        instrument.disable()
+        self.assertEqual(Work().run([1]), [2])
+
+        run = sink.scopes["run"]
+        unscoped = sink.scopes["unscoped"]["ops"]
+        self.assertEqual(run["count"], 2)
+        self.assertEqual(run["ops"]["step"][0], 3)
+        self.assertEqual(run["ops"]["double"][0], 1 + 2 + 3)
+        # The scope was registered last, so it wraps the work operation.
+        self.assertEqual(run["ops"]["work"][0], 2)
+        self.assertEqual(sink.scopes["unscoped"]["ops"], {"step": [1, unscoped["step"][1]],
+                                                          "double": [5, unscoped["double"][1]]})
+
+    def test_capture(self):
+        self.assertEqual(instrument.capture(Work().step, 1), (2, None))
+        sink = instrument.Aggregator()
+        instrument.enable(sink)
+        result, ops = instrument.capture(Work().run, [1, 2])
+        self.assertEqual(result, [2, 4])
+        Work().resume(ops)
+        Work().resume(None)
+        instrument.disable()
+        self.assertEqual(sink.scopes["run"]["count"], 1)
+        self.assertEqual(sink.scopes["resume"]["count"], 2)
+        self.assertEqual(sink.scopes["resume"]["ops"]["step"][0], 2)
+        self.assertEqual(sink.scopes["resume"]["ops"]["double"][0], 3)
+        self.assertFalse("unscoped" in sink.scopes)
+
+    def test_file_dump(self):
+        d = tempfile.mkdtemp()
+        try:
+            path = os.path.join(d, "stats.json")
+            instrument.enable(instrument.FileDump(path, interval=0))
+            Work().run([1])
+            Work().step(1)
+            with open(path) as f:
+                self.assertEqual(json.load(f)["scopes"]["run"]["ops"]["step"][0], 1)
+            instrument.disable()
+            with open(path) as f:
+                self.assertTrue("unscoped" in json.load(f)["scopes"])
+        finally:
+            shutil.rmtree(d)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,124 @@
+"""Jacobian coordinates for curves y^2 = x^3 + a*x + b over Z/p.
+
+The tuple (X, Y, Z) stands for the affine point (X/Z^2, Y/Z^3), and
+any tuple with Z == 0 for the point at infinity. Additions and
+doublings need no field inversion, only the conversion back to affine
+coordinates does. batch_to_affine and normalize share a single
+inversion between many points.
+
+Curve instances provide the group interface used by multiexp.
+"""
+
+
+def batch_inverse(values, p):
+    """Returns the inverses of the non-zero values modulo p.
+
+    Uses Montgomery's trick: one modular inversion and three
+    multiplications per value.
+    """
+    prefix = []
+    acc = 1
+    for v in values:
+        prefix.append(acc)
+        acc = acc * v % p
+    inv = pow(acc, p - 2, p)
+    res = [0] * len(values)
+    for i in range(len(values) - 1, -1, -1):
+        res[i] = inv * prefix[i] % p
+        inv = inv * values[i] % p
+    return res
+
+
+class Curve(object):
+    """Point arithmetic in Jacobian coordinates. b only enters via the affine points."""
+
+    identity = (1, 1, 0)
+
+    def __init__(self, p, a):
+        self.p = p
+        self.a = a
+
+    def from_affine(self, x, y):
+        return (x, y, 1)
+
+    def is_identity(self, P):
+        return P[2] == 0
+
+    def neg(self, P):
+        X, Y, Z = P
+        return (X, -Y % self.p, Z)
+
+    def double(self, P):
+        X, Y, Z = P
+        if Z == 0 or Y == 0:
+            return self.identity
+        p = self.p
+        YY = Y * Y % p
+        S = 4 * X * YY % p
+        M = 3 * X * X
+        if self.a:
+            ZZ = Z * Z % p
+            M += self.a * ZZ * ZZ
+        M %= p
+        X3 = (M * M - 2 * S) % p
+        Y3 = (M * (S - X3) - 8 * YY * YY) % p
+        Z3 = 2 * Y * Z % p
+        return (X3, Y3, Z3)
+
+    def plus(self, P, Q):
+        X1, Y1, Z1 = P
+        X2, Y2, Z2 = Q
+        if Z1 == 0:
+            return Q
+        if Z2 == 0:
+            return P
+        p = self.p
+        Z1Z1 = Z1 * Z1 % p
+        U2 = X2 * Z1Z1 % p
+        S2 = Y2 * Z1 * Z1Z1 % p
+        if Z2 == 1:
+            # Mixed addition with an affine Q saves four multiplications.
+            U1, S1 = X1, Y1
+        else:
+            Z2Z2 = Z2 * Z2 % p
+            U1 = X1 * Z2Z2 % p
+            S1 = Y1 * Z2 * Z2Z2 % p
+        H = (U2 - U1) % p
+        R = (S2 - S1) % p
+        if H == 0:
+            if R == 0:
+                return self.double(P)
+            return self.identity
+        HH = H * H % p
+        HHH = H * HH % p
+        V = U1 * HH % p
+        X3 = (R * R - HHH - 2 * V) % p
+        Y3 = (R * (V - X3) - S1 * HHH) % p
+        Z3 = Z1 * H % p
+        if Z2 != 1:
+            Z3 = Z3 * Z2 % p
+        return (X3, Y3, Z3)
+
+    def to_affine(self, P):
+        """Returns (x, y), or None for the point at infinity."""
+        return self.batch_to_affine([P])[0]
+
+    def batch_to_affine(self, points):
+        """Like to_affine for many points, with a single field inversion."""
+        p = self.p
+        finite = [P for P in points if P[2] != 0]
+        invs = iter(batch_inverse([P[2] for P in finite], p))
+        res = []
+        for X, Y, Z in points:
+            if Z == 0:
+                res.append(None)
+                continue
+            zi = next(invs)
+            zi2 = zi * zi % p
+            res.append((X * zi2 % p, Y * zi2 * zi % p))
+        return res
+
+    def normalize(self, points):
+        """Returns the same points with Z == 1, or the identity for infinity."""
+        return [self.identity if a is None else (a[0], a[1], 1)
+                for a in self.batch_to_affine(points)]
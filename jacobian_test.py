@@ -0,0 +1,87 @@
+#! /usr/bin/env nix-shell
+#! nix-shell -i python2 -p "with python2Packages; [python]"
+
+from jacobian import *
+import multiexp
+import random
+import unittest
+
+random.seed(70)
+
+p = 2 ** 256 - 2 ** 32 - 977
+n = 0xFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFEBAAEDCE6AF48A03BBFD25E8CD0364141
+G = (0x79BE667EF9DCBBAC55A06295CE870B07029BFCDB2DCE28D959F2815B16F81798,
+     0x483ADA7726A3C4655DA4FBFC0E1108A8FD17B448A68554199C47D08FFB10D4B8)
+G2 = (0xC6047F9441ED7D6D3045406E95C07CD85C778E4B8CEF3CA7ABAC09B95C709EE5,
+      0x1AE168FEA63DC339A3C58419466CEAEEF7F632653266D0E1236431A950CFE52A)
+
+
+def affine_plus(P, Q):
+    """Textbook affine addition on secp256k1, None being infinity."""
+    if P is None:
+        return Q
+    if Q is None:
+        return P
+    if P[0] == Q[0]:
+        if (P[1] + Q[1]) % p == 0:
+            return None
+        l = 3 * P[0] * P[0] * pow(2 * P[1], p - 2, p) % p
+    else:
+        l = (Q[1] - P[1]) * pow(Q[0] - P[0], p - 2, p) % p
+    x = (l * l - P[0] - Q[0]) % p
+    return (x, (l * (P[0] - x) - P[1]) % p)
+
+
+class CurveTest(unittest.TestCase):
+    def setUp(self):
+        self.c = Curve(p, 0)
+        self.G = self.c.from_affine(*G)
+
+    def test_double(self):
+        self.assertEqual(self.c.to_affine(self.c.double(self.G)), G2)
+        self.assertEqual(self.c.to_affine(self.c.plus(self.G, self.G)), G2)
+
+    def test_plus(self):
+        A = None
+        J = self.c.identity
+        for i in range(10):
+            A = affine_plus(A, G)
+            J = self.c.plus(J, self.G)
+            # Also mix in non-normalized points.
+            J = self.c.plus(self.c.double(J), self.c.neg(J))
+            self.assertEqual(self.c.to_affine(J), A)
+
+    def test_inverse(self):
+        self.assertTrue(self.c.is_identity(self.c.plus(self.G, self.c.neg(self.G))))
+        self.assertEqual(self.c.to_affine(self.c.identity), None)
+
+    def test_order(self):
+        self.assertTrue(self.c.is_identity(multiexp.multiply(self.c, [n], [self.G])))
+        self.assertEqual(self.c.to_affine(multiexp.multiply(self.c, [n + 2], [self.G])), G2)
+
+    def test_batch(self):
+        points = [self.G, self.c.identity]
+        for i in range(5):
+            points.append(self.c.double(points[-2]))
+        self.assertEqual(self.c.batch_to_affine(points), [self.c.to_affine(P) for P in points])
+        for P, Q in zip(self.c.normalize(points), points):
+            self.assertTrue(P[2] in (0, 1))
+            self.assertEqual(self.c.to_affine(P), self.c.to_affine(Q))
+
+    def test_batch_inverse(self):
+        values = [random.randrange(1, p) for i in range(10)]
+        for v, inv in zip(values, batch_inverse(values, p)):
+            self.assertEqual(v * inv % p, 1)
+        self.assertEqual(batch_inverse([], p), [])
+
+    def test_multiexp(self):
+        table = multiexp.FixedBaseTable(self.c, self.G)
+        for i in range(3):
+            k = random.randrange(n)
+            expected = self.c.to_affine(multiexp.strauss(self.c, [(k, self.G)]))
+            self.assertEqual(self.c.to_affine(table.multiply(k)), expected)
+            self.assertEqual(self.c.to_affine(multiexp.pippenger(self.c, [(k, self.G)])), expected)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,46 @@
+"""A size bounded mapping that evicts the least recently used entry."""
+
+import collections
+
+
+class LRUCache(object):
+    """Holds at most maxsize entries. get() and put() count as use.
+
+    hits and misses count the lookups by get().
+    """
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.data = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.data)
+
+    def __contains__(self, key):
+        return key in self.data
+
+    def get(self, key, default=None):
+        try:
+            value = self.data.pop(key)
+        except KeyError:
+            self.misses += 1
+            return default
+        self.hits += 1
+        self.data[key] = value
+        return value
+
+    def hit_rate(self):
+        """Returns the share of get() calls that found their key, or 0.0 before any."""
+        lookups = self.hits + self.misses
+        return float(self.hits) / lookups if lookups else 0.0
+
+    def put(self, key, value):
+        self.data.pop(key, None)
+        self.data[key] = value
+        if len(self.data) > self.maxsize:
+            self.data.popitem(last=False)
+
+    def clear(self):
+        self.data.clear()
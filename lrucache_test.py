@@ -0,0 +1,42 @@
+#! /usr/bin/env nix-shell
+#! nix-shell -i python2 -p "with python2Packages; [python]"
+
+from lrucache import *
+import unittest
+
+
+class LRUCacheTest(unittest.TestCase):
+    def test_evict(self):
+        c = LRUCache(2)
+        c.put(1, "a")
+        c.put(2, "b")
+        self.assertEqual(c.get(1), "a")
+        c.put(3, "c")
+        self.assertEqual(len(c), 2)
+        self.assertFalse(2 in c)
+        self.assertEqual(c.get(2), None)
+        self.assertEqual(c.get(1), "a")
+        self.assertEqual(c.get(3), "c")
+
+    def test_put_existing(self):
+        c = LRUCache(2)
+        c.put(1, "a")
+        c.put(2, "b")
+        c.put(1, "x")
+        c.put(3, "c")
+        self.assertEqual(c.get(1), "x")
+        self.assertFalse(2 in c)
+
+    def test_hit_rate(self):
+        c = LRUCache(2)
+        self.assertEqual(c.hit_rate(), 0.0)
+        c.put(1, "a")
+        c.get(1)
+        c.get(2)
+        c.get(1)
+        self.assertEqual((c.hits, c.misses), (2, 1))
+        self.assertAlmostEqual(c.hit_rate(), 2.0 / 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
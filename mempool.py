@@ -0,0 +1,162 @@
+"""Pool of validated, not yet confirmed transactions.
+
+The chain modules subclass Mempool and define what a transaction spends
+and creates, and how it is validated against the chain and the pool.
+Spends and creations are indexed by their key, an outpoint for the
+basic chain and a commitment point for Mimblewimble, so conflicts and
+dependencies between pooled transactions are found in O(1).
+"""
+
+import collections
+import heapq
+import itertools
+
+
+class ConflictError(Exception):
+    pass
+
+
+class MempoolFullError(Exception):
+    pass
+
+
+# key identifies the tx in the pool, spends and creates list the keys of
+# the outputs it spends and creates.
+Entry = collections.namedtuple("Entry", ["key", "tx", "spends", "creates", "size", "fee", "seq"])
+
+# Bytes of encoded transactions a pool holds by default.
+MAX_SIZE = 64 * 2 ** 20
+
+
+class Mempool(object):
+    """Validated transactions, at most max_size encoded bytes of them.
+
+    Subclasses implement describe(tx), returning (key, spends, creates,
+    size), and validate(tx), which raises the chain's errors for an
+    invalid tx and returns its fee otherwise.
+    """
+
+    def __init__(self, chain, max_size=MAX_SIZE):
+        self.chain = chain
+        self.max_size = max_size
+        self.size = 0
+        self.entries = {}
+        # Output key to the key of the pooled tx spending or creating it
+        self.spent_by = {}
+        self.created_by = {}
+        # Keys of the pooled txs a pooled tx spends from, and the reverse
+        self.parents = {}
+        self.children = {}
+        self.seq = itertools.count()
+        # Lazily cleaned heap of (feerate, -seq, key) to evict from
+        self.evict_heap = []
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def add(self, tx):
+        """Validates tx against the chain and the pool and adds it. Returns its key.
+
+        Raises ConflictError if a pooled tx spends the same output, and
+        MempoolFullError if tx itself would be evicted right away. Adding
+        a pooled tx again does nothing.
+        """
+        key, spends, creates, size = self.describe(tx)
+        if key in self.entries:
+            return key
+        for k in spends:
+            if k in self.spent_by:
+                raise ConflictError("Output %s is already spent by a pooled transaction" % (k,))
+        fee = self.validate(tx)
+        entry = Entry(key, tx, spends, creates, size, fee, next(self.seq))
+        self.entries[key] = entry
+        self.size += size
+        self.spent_by.update((k, key) for k in spends)
+        self.created_by.update((k, key) for k in creates)
+        self.parents[key] = set(self.created_by[k] for k in spends if k in self.created_by)
+        self.children[key] = set()
+        for parent in self.parents[key]:
+            self.children[parent].add(key)
+        heapq.heappush(self.evict_heap, (self.feerate(entry), -entry.seq, key))
+        self._evict()
+        if key not in self.entries:
+            raise MempoolFullError("Mempool is full")
+        return key
+
+    def feerate(self, entry):
+        return float(entry.fee) / max(entry.size, 1)
+
+    def _evict(self):
+        while self.size > self.max_size:
+            feerate, seq, key = heapq.heappop(self.evict_heap)
+            entry = self.entries.get(key)
+            if entry is not None and entry.seq == -seq:
+                self.remove(key, descendants=True)
+        if len(self.evict_heap) > 2 * len(self.entries) + 64:
+            self.evict_heap = [(self.feerate(e), -e.seq, e.key) for e in self.entries.values()]
+            heapq.heapify(self.evict_heap)
+
+    def remove(self, key, descendants=False):
+        """Removes a pooled tx, and with descendants all pooled txs spending from it."""
+        if descendants:
+            for child in list(self.children.get(key, ())):
+                self.remove(child, descendants=True)
+        entry = self.entries.pop(key, None)
+        if entry is None:
+            return
+        self.size -= entry.size
+        for k in entry.spends:
+            del self.spent_by[k]
+        for k in entry.creates:
+            del self.created_by[k]
+        for parent in self.parents.pop(key):
+            self.children[parent].discard(key)
+        for child in self.children.pop(key):
+            self.parents[child].discard(key)
+
+    def remove_block(self, txs):
+        """Drops the txs of an accepted block, and the pooled txs conflicting with them."""
+        for tx in txs:
+            key, spends, creates, size = self.describe(tx)
+            if key in self.entries:
+                # Its descendants now spend confirmed outputs.
+                self.remove(key)
+                continue
+            for k in spends:
+                if k in self.spent_by:
+                    self.remove(self.spent_by[k], descendants=True)
+
+    def ancestors(self, key):
+        """Returns the keys of the pooled txs key depends on, directly or not."""
+        result = set()
+        stack = list(self.parents[key])
+        while stack:
+            k = stack.pop()
+            if k not in result:
+                result.add(k)
+                stack.extend(self.parents[k])
+        return result
+
+    def block_template(self, max_size=None):
+        """Returns pooled txs for a block of at most max_size encoded bytes.
+
+        Picks txs by descending feerate, each together with the pooled
+        txs it depends on, and returns them in the order they were
+        added, which puts parents before their children. Nothing is
+        validated again.
+        """
+        selected = set()
+        total = 0
+        for entry in sorted(self.entries.values(), key=lambda e: (-self.feerate(e), e.seq)):
+            if entry.key in selected:
+                continue
+            package = [k for k in self.ancestors(entry.key) if k not in selected] + [entry.key]
+            size = sum(self.entries[k].size for k in package)
+            if max_size is not None and total + size > max_size:
+                continue
+            selected.update(package)
+            total += size
+        return [self.entries[k].tx for k in sorted(selected, key=lambda k: self.entries[k].seq)]
@@ -0,0 +1,82 @@
+#! /usr/bin/env nix-shell
+#! nix-shell -i python2 -p "with python2Packages; [python]"
+
+from mempool import *
+import collections
+import unittest
+
+ToyTx = collections.namedtuple("ToyTx", ["name", "spends", "creates", "fee", "size"])
+
+
+class ToyPool(Mempool):
+    """Pool over a chain that is just the set of unspent output names."""
+
+    def describe(self, tx):
+        return (tx.name, tx.spends, tx.creates, tx.size)
+
+    def validate(self, tx):
+        for k in tx.spends:
+            if k not in self.chain and k not in self.created_by:
+                raise ValueError("%s not found" % k)
+        return tx.fee
+
+
+class MempoolTest(unittest.TestCase):
+    def setUp(self):
+        self.pool = ToyPool(set(["g0", "g1", "g2"]), max_size=4)
+        self.a = ToyTx("a", ["g0"], ["a0"], 1, 1)
+        # Spends the output of a
+        self.b = ToyTx("b", ["a0"], ["b0"], 10, 1)
+        self.c = ToyTx("c", ["g1"], ["c0"], 5, 1)
+
+    def test_conflict(self):
+        self.pool.add(self.a)
+        self.assertEqual(self.pool.add(self.a), "a")
+        with self.assertRaises(ConflictError):
+            self.pool.add(ToyTx("x", ["g0"], [], 100, 1))
+        with self.assertRaises(ValueError):
+            self.pool.add(ToyTx("y", ["nope"], [], 100, 1))
+        self.assertEqual(len(self.pool), 1)
+
+    def test_dependencies(self):
+        for tx in [self.a, self.b, self.c]:
+            self.pool.add(tx)
+        self.assertEqual(self.pool.parents["b"], set(["a"]))
+        self.assertEqual(self.pool.ancestors("b"), set(["a"]))
+        self.pool.remove("a", descendants=True)
+        self.assertEqual(sorted(self.pool.entries), ["c"])
+        self.assertEqual(self.pool.size, 1)
+        self.assertFalse("a0" in self.pool.created_by)
+
+    def test_evict(self):
+        for tx in [self.a, self.b, self.c, ToyTx("d", ["g2"], [], 3, 1)]:
+            self.pool.add(tx)
+        # a has the lowest feerate, evicting it takes b along.
+        self.pool.add(ToyTx("e", [], [], 4, 1))
+        self.assertEqual(sorted(self.pool.entries), ["c", "d", "e"])
+        self.pool.add(ToyTx("f", [], [], 12, 2))
+        self.assertEqual(sorted(self.pool.entries), ["c", "e", "f"])
+        with self.assertRaises(MempoolFullError):
+            self.pool.add(ToyTx("g", [], [], 1, 1))
+        self.assertEqual(self.pool.size, 4)
+
+    def test_block_template(self):
+        for tx in [self.a, self.c, self.b]:
+            self.pool.add(tx)
+        # b pulls in its parent a, which pays less than c.
+        self.assertEqual(self.pool.block_template(), [self.a, self.c, self.b])
+        self.assertEqual(self.pool.block_template(2), [self.a, self.b])
+        self.assertEqual(self.pool.block_template(1), [self.c])
+
+    def test_remove_block(self):
+        for tx in [self.a, self.b, self.c]:
+            self.pool.add(tx)
+        self.pool.chain.update(["a0"])
+        self.pool.remove_block([self.a, ToyTx("x", ["g1"], [], 0, 1)])
+        self.assertEqual(sorted(self.pool.entries), ["b"])
+        self.assertEqual(self.pool.parents["b"], set())
+        self.assertEqual(self.pool.block_template(), [self.b])
+
+
+if __name__ == '__main__':
+    unittest.main()
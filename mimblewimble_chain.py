@@ -1,11 +1,20 @@
 #! /usr/bin/env nix-shell
-#! nix-shell -i python2 -p "with python2Packages; [python]"
+#! nix-shell -i python2 -p "with python2Packages; [python futures]"
 
+import binascii
 import hashlib
 import collections
 import os
 import random
+import struct
+from functools import reduce
 
+import coinselect
+import instrument
+import jacobian
+import lrucache
+import mempool
+import multiexp
 from toycrypto.ec import *
 from toycrypto.primefields import *
 
@@ -17,6 +26,139 @@ secp256k1 = EC(z, z.make(0), z.make(7))
 G = secp256k1.fromX(z.make(0x19BE667EF9DCBBAC55A06295CE870B07029BFCDB2DCE28D959F2815B16F81797))
 H = secp256k1.fromX(z.make(0x79BE667EF9DCBBAC55A06295CE870B07029BFCDB2DCE28D959F2815B16F81798))
 
+_batch_random = random.SystemRandom()
+
+
+def _sha256(data):
+    return hashlib.sha256(data).digest()
+
+
+# Curve arithmetic is done on Jacobian coordinates, which need no
+# field inversion per addition. Points are converted from and back to
+# toycrypto points only at the API boundary.
+curve = jacobian.Curve(p, 0)
+_identity = secp256k1.plus(G, G.plusInv())
+
+
+def to_jacobian(P):
+    """Converts a toycrypto point to Jacobian coordinates."""
+    if P.isPlusID():
+        return curve.identity
+    return curve.from_affine(int(P.x), int(P.y))
+
+
+def _point(x, y):
+    """Returns the toycrypto point (x, y), which must be on the curve.
+
+    Uses the point constructor secp256k1.make where toycrypto has one.
+    Unlike secp256k1.fromX, it takes no square root, which costs as
+    much as the inversions saved by batch_from_jacobian.
+    """
+    if _make_point is not None:
+        return _make_point(z.make(x), z.make(y))
+    P = secp256k1.fromX(z.make(x))
+    if int(P.y) != y:
+        P = P.plusInv()
+    return P
+
+_make_point = getattr(secp256k1, "make", None)
+if _make_point is not None and _point(int(G.x), int(G.y)) != G:
+    raise ImportError("toycrypto EC.make does not take affine coordinates")
+
+
+def _from_affine(a):
+    if a is None:
+        return _identity
+    return _point(*a)
+
+
+def from_jacobian(J):
+    """Converts Jacobian coordinates back to a toycrypto point."""
+    return _from_affine(curve.to_affine(J))
+
+
+def batch_from_jacobian(Js):
+    """Like from_jacobian for many points, with a single field inversion."""
+    return [_from_affine(a) for a in curve.batch_to_affine(Js)]
+
+_G = to_jacobian(G)
+_H = to_jacobian(H)
+
+# Points are encoded in 33 bytes, a prefix of 2 or 3 for even or odd y
+# followed by the 32 byte x. All zero bytes encode the point at infinity.
+POINT_SIZE = 33
+_INFINITY_BYTES = b"\x00" * POINT_SIZE
+
+
+def encode_int(k):
+    """Encodes 0 <= k < 2^256 as 32 big endian bytes."""
+    return binascii.unhexlify("%064x" % k)
+
+
+def decode_int(data):
+    return int(binascii.hexlify(data), 16)
+
+
+def encode_point(P):
+    """Returns the 33 byte compressed encoding of the point P."""
+    if P.isPlusID():
+        return _INFINITY_BYTES
+    y = int(P.y)
+    return struct.pack("B", 2 + (y & 1)) + encode_int(int(P.x))
+
+
+def decode_point(data):
+    """Decompresses an encoded point given as bytes or memoryview."""
+    if isinstance(data, memoryview):
+        data = data.tobytes()
+    if len(data) != POINT_SIZE:
+        raise ValueError("Point encoding must have %d bytes" % POINT_SIZE)
+    if data == _INFINITY_BYTES:
+        return _identity
+    prefix = struct.unpack_from("B", data)[0]
+    x = decode_int(data[1:])
+    if prefix not in (2, 3) or x >= p:
+        raise ValueError("Invalid point encoding")
+    rhs = (x * x * x + 7) % p
+    # p = 3 mod 4, so this is a square root of rhs if there is one.
+    y = pow(rhs, (p + 1) // 4, p)
+    if y * y % p != rhs:
+        raise ValueError("Encoded point is not on the curve")
+    if y & 1 != prefix & 1:
+        y = p - y
+    return _point(x, y)
+
+# Fixed-base tables for G and H, built on first use. Set
+# MIMBLEWIMBLE_TABLE_DIR to keep them on disk across processes.
+TABLE_DIR = os.environ.get("MIMBLEWIMBLE_TABLE_DIR")
+
+
+def _table_path(name):
+    if TABLE_DIR is None:
+        return None
+    return os.path.join(TABLE_DIR, "%s.table" % name)
+
+_fixed = {_G: multiexp.FixedBaseTable(curve, _G, path=_table_path("G")),
+          _H: multiexp.FixedBaseTable(curve, _H, path=_table_path("H"))}
+
+
+def jacobian_msm(scalars, points):
+    """Like msm, but takes and returns points in Jacobian coordinates."""
+    return multiexp.multiply(curve, scalars, points, _fixed)
+
+
+def jacobian_sum(points):
+    """Returns the sum of points in Jacobian coordinates."""
+    acc = curve.identity
+    for P in points:
+        acc = curve.plus(acc, P)
+    return acc
+
+
+def msm(scalars, points):
+    """Returns the point sum(k * P for k, P in zip(scalars, points))."""
+    return from_jacobian(jacobian_msm(scalars, [to_jacobian(P) for P in points]))
+
 # I could rename this open commitment
 class OwnedOutput(collections.namedtuple("OwnedOutput", ["value", "bf"])):
     @classmethod
@@ -25,10 +167,32 @@ class OwnedOutput(collections.namedtuple("OwnedOutput", ["value", "bf"])):
 
     # Rename this function .commit()?
     def blind(self):
-        res = secp256k1.plus(H.scalarMul(int(self.bf)), G.scalarMul(self.value))
+        res = _commitments.get(self)
+        if res is None:
+            res = from_jacobian(self.jacobian_blind())
+            _commitments.put(self, res)
 #        print "%s * G + %s * H = %s" % (self.value, self.bf, res)
         return res
 
+    def jacobian_blind(self):
+        return jacobian_msm([int(self.bf), self.value], [_H, _G])
+
+    @classmethod
+    def blind_many(cls, outputs):
+        """Returns [o.blind() for o in outputs], sharing one field inversion."""
+        res = [_commitments.get(o) for o in outputs]
+        missing = [i for i, P in enumerate(res) if P is None]
+        points = batch_from_jacobian([outputs[i].jacobian_blind() for i in missing])
+        for i, P in zip(missing, points):
+            res[i] = P
+            _commitments.put(outputs[i], P)
+        return res
+
+# Commitments of recently used OwnedOutputs. Bounded, as wallets can
+# hold arbitrarily many outputs.
+COMMITMENT_CACHE_SIZE = 2 ** 16
+_commitments = lrucache.LRUCache(COMMITMENT_CACHE_SIZE)
+
 
 class InputReferenceError(Exception):
     pass
@@ -44,9 +208,10 @@ class OwnedTransaction(collections.namedtuple("OwnedTransaction", ["inputs", "ou
         """Closes the transaction with adding excess_r"""
         v = sum([o.value for o in self.inputs] + [-o.value for o in self.outputs])
         r = reduce(Signature.nF.plus, [o.bf for o in self.inputs] + [o.bf.plusInv() for o in self.outputs], excess_r)
-        t = Transaction(inputs = [o.blind() for o in self.inputs],
-                        outputs = [o.blind() for o in self.outputs],
-                        excess = OwnedOutput(0, excess_r).blind(),
+        points = OwnedOutput.blind_many(self.inputs + self.outputs + [OwnedOutput(0, excess_r)])
+        t = Transaction(inputs = points[:len(self.inputs)],
+                        outputs = points[len(self.inputs):-1],
+                        excess = points[-1],
                         signature = Signature.sign(Signature.WITNESS_MAGIC, excess_r))
         return (t, v, r)
 
@@ -60,24 +225,513 @@ class Transaction(collections.namedtuple("Transaction", ["inputs", "outputs", "e
                            excess = secp256k1.plus(t1.excess, t2.excess),
                            signature = Signature.merge(t1.signature, t2.signature))
 
+    @classmethod
+    def aggregate(cls, txs):
+        """Merges txs into a single transaction with cut-through.
+
+        An output of one tx that is spent by an input of another is
+        dropped together with that input, so only the net inputs and
+        outputs remain. Excesses and signatures are each summed in one
+        pass.
+        """
+        txs = list(txs)
+        unspent = collections.Counter(P for tx in txs for P in tx.outputs)
+        inputs = []
+        for tx in txs:
+            for P in tx.inputs:
+                if unspent[P] > 0:
+                    unspent[P] -= 1
+                else:
+                    inputs.append(P)
+        outputs = []
+        for tx in txs:
+            for P in tx.outputs:
+                if unspent[P] > 0:
+                    unspent[P] -= 1
+                    outputs.append(P)
+        excess, K = batch_from_jacobian([jacobian_sum(to_jacobian(tx.excess) for tx in txs),
+                                         jacobian_sum(to_jacobian(tx.signature.K) for tx in txs)])
+        s = sum(int(tx.signature.s) for tx in txs) % Signature.Hfield.order
+        return Transaction(inputs, outputs, excess, Signature(Signature.nF.make(s), K))
+
     def sum(self):
         """Returns the transaction sum."""
-        return reduce(secp256k1.plus, self.inputs + [o.plusInv() for o in self.outputs], self.excess)
+        return _tx_sum(self)
+
+    # Number of inputs and outputs, each 4 bytes. They are followed by
+    # the encoded inputs, outputs, excess and signature.
+    COUNTS = struct.Struct(">II")
+
+    def serialize(self):
+        return b"".join([Transaction.COUNTS.pack(len(self.inputs), len(self.outputs))] +
+                        [encode_point(P) for P in self.inputs] +
+                        [encode_point(P) for P in self.outputs] +
+                        [encode_point(self.excess), self.signature.serialize()])
+
+    @classmethod
+    def deserialize(cls, buf):
+        """Decodes a Transaction, decompressing all points right away. See WireTransaction."""
+        return WireTransaction(buf).decode()
+
+
+def _encode_tx(tx):
+    if isinstance(tx, WireTransaction):
+        return tx.buf.tobytes()
+    return tx.serialize()
+
+
+# Transactions found balanced, by the sha256 of their encoding, and
+# kernels whose signature was found valid, by the encoded excess and
+# signature. A tx seen by a mempool first is not checked again when it
+# comes in a block.
+VERIFY_CACHE_SIZE = 2 ** 16
+sum_cache = lrucache.LRUCache(VERIFY_CACHE_SIZE)
+kernel_cache = lrucache.LRUCache(VERIFY_CACHE_SIZE)
+
+
+def _cache_keys(tx):
+    """Returns the sum_cache and kernel_cache keys of tx."""
+    data = _encode_tx(tx)
+    # The encoding ends with the excess and the signature.
+    return _sha256(data), data[-(POINT_SIZE + Signature.SIZE):]
+
+
+def _tx_sum(tx):
+    return msm([1] * (len(tx.inputs) + 1) + [-1] * len(tx.outputs),
+               list(tx.inputs) + [tx.excess] + list(tx.outputs))
+
+
+class LazyPoints(object):
+    """Sequence of n encoded points at offset in buf, decompressed on first access."""
+
+    def __init__(self, buf, offset, n):
+        self.buf = buf
+        self.offset = offset
+        self.points = [None] * n
+
+    def __len__(self):
+        return len(self.points)
+
+    def raw(self, i):
+        """Returns the encoding of point i as a memoryview, without decompressing it."""
+        if not 0 <= i < len(self.points):
+            raise IndexError(i)
+        start = self.offset + i * POINT_SIZE
+        return self.buf[start:start + POINT_SIZE]
+
+    def encodings(self):
+        """Returns the encodings of all points, without decompressing them."""
+        return [self.raw(i).tobytes() for i in range(len(self.points))]
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += len(self.points)
+        P = self.points[i]
+        if P is None:
+            P = self.points[i] = decode_point(self.raw(i))
+        return P
+
+    def __iter__(self):
+        for i in range(len(self.points)):
+            yield self[i]
+
+
+class WireTransaction(object):
+    """A Transaction in its wire format, see Transaction.serialize.
+
+    Keeps a memoryview on buf instead of copying it. Points are only
+    decompressed when used, and their encodings are available through
+    inputs.raw(i) and outputs.raw(i).
+    """
+
+    def __init__(self, buf):
+        self.buf = memoryview(buf)
+        if len(self.buf) < Transaction.COUNTS.size:
+            raise ValueError("Transaction encoding ends within its counts")
+        n_in, n_out = Transaction.COUNTS.unpack_from(self.buf, 0)
+        offset = Transaction.COUNTS.size
+        self.inputs = LazyPoints(self.buf, offset, n_in)
+        offset += n_in * POINT_SIZE
+        self.outputs = LazyPoints(self.buf, offset, n_out)
+        offset += n_out * POINT_SIZE
+        self.kernel = LazyPoints(self.buf, offset, 1)
+        offset += POINT_SIZE
+        self.signature_offset = offset
+        if offset + Signature.SIZE != len(self.buf):
+            raise ValueError("Transaction encoding has %d bytes, expected %d" %
+                             (len(self.buf), offset + Signature.SIZE))
+        self._signature = None
+
+    @property
+    def excess(self):
+        return self.kernel[0]
+
+    @property
+    def signature(self):
+        if self._signature is None:
+            self._signature = Signature.unpack_from(self.buf, self.signature_offset)
+        return self._signature
+
+    def sum(self):
+        """Returns the transaction sum."""
+        return _tx_sum(self)
+
+    def decode(self):
+        """Returns the fully decoded Transaction."""
+        return Transaction(list(self.inputs), list(self.outputs), self.excess, self.signature)
+
+
+def point_key(p):
+    """Returns the encoding utxo sets are keyed by, of a point or of an encoding."""
+    if isinstance(p, bytes):
+        return p
+    if isinstance(p, memoryview):
+        return p.tobytes()
+    return encode_point(p)
+
+
+def _encodings(points):
+    if isinstance(points, LazyPoints):
+        return points.encodings()
+    return [encode_point(P) for P in points]
+
+
+class PointSet(object):
+    """Set of points, kept as their encodings.
+
+    Takes points or encodings, so that the points of WireTransactions
+    are looked up without decompressing them. Iterating decompresses,
+    encodings() does not.
+    """
+
+    def __init__(self, points=()):
+        self.keys = set(point_key(p) for p in points)
+
+    def __len__(self):
+        return len(self.keys)
+
+    def __contains__(self, p):
+        return point_key(p) in self.keys
+
+    def add(self, p):
+        self.keys.add(point_key(p))
+
+    def update(self, ps):
+        self.keys.update(point_key(p) for p in ps)
+
+    def remove(self, p):
+        self.keys.remove(point_key(p))
+
+    def encodings(self):
+        return iter(self.keys)
+
+    def __iter__(self):
+        for k in self.keys:
+            yield decode_point(k)
+
+
+class UtxoView(object):
+    """Copy-free overlay over a UTXO set of blinded output points.
+
+    Spent and created points are kept in a delta that is merged into the
+    underlying set on commit(). Dropping the view rolls them back. Like
+    PointSet, it takes points or encodings and keys by the encodings.
+    """
+
+    def __init__(self, base):
+        self.base = base
+        self.spent = set()
+        self.created = set()
+
+    def __contains__(self, p):
+        k = point_key(p)
+        if k in self.created:
+            return True
+        return k not in self.spent and k in self.base
+
+    def add(self, p):
+        self.created.add(point_key(p))
+
+    def update(self, ps):
+        self.created.update(point_key(p) for p in ps)
+
+    def remove(self, p):
+        k = point_key(p)
+        if k in self.created:
+            self.created.remove(k)
+        elif k in self.spent or k not in self.base:
+            raise KeyError(k)
+        else:
+            self.spent.add(k)
+
+    def commit(self):
+        """Merges the delta into the base set."""
+        for p in self.spent:
+            self.base.remove(p)
+        self.base.update(self.created)
+        self.spent = set()
+        self.created = set()
+
+    def encodings(self):
+        for k in self.base.encodings():
+            if k not in self.spent and k not in self.created:
+                yield k
+        for k in self.created:
+            yield k
+
+    def __iter__(self):
+        for k in self.encodings():
+            yield decode_point(k)
+
+
+class SnapshotSet(object):
+    """Read-only UTXO set on a blockstore.Snapshot of encoded points."""
+
+    def __init__(self, snapshot):
+        self.snapshot = snapshot
+
+    def __contains__(self, p):
+        return point_key(p) in self.snapshot
+
+    def encodings(self):
+        for k in self.snapshot.keys():
+            yield bytes(k)
+
+    def __iter__(self):
+        for k in self.encodings():
+            yield decode_point(k)
+
+
+# Blocks are stored as the number of transactions, followed by the
+# length and the encoding of each transaction.
+COUNT = struct.Struct(">I")
+
+
+def encode_block(txs):
+    parts = [COUNT.pack(len(txs))]
+    for tx in txs:
+        data = _encode_tx(tx)
+        parts += [COUNT.pack(len(data)), data]
+    return b"".join(parts)
+
+
+def decode_block(buf):
+    """Decodes a list of WireTransactions, which reference buf instead of copying it.
+
+    Raises ValueError unless buf holds exactly one encoded block.
+    """
+    buf = memoryview(buf)
+    if len(buf) < COUNT.size:
+        raise ValueError("Block encoding ends within its count")
+    n = COUNT.unpack_from(buf, 0)[0]
+    offset = COUNT.size
+    txs = []
+    for i in range(n):
+        if offset + COUNT.size > len(buf):
+            raise ValueError("Block encoding ends within a length")
+        length = COUNT.unpack_from(buf, offset)[0]
+        offset += COUNT.size
+        if offset + length > len(buf):
+            raise ValueError("Block encoding ends within a transaction")
+        txs.append(WireTransaction(buf[offset:offset + length]))
+        offset += length
+    if offset != len(buf):
+        raise ValueError("%d trailing bytes after block" % (len(buf) - offset))
+    return txs
+
+
+def check_encoded(datas):
+    """Runs Chain.check_txs on a list of encoded transactions.
+
+    Only takes and returns picklable values, so that it can run in a
+    process pool.
+    """
+    return Chain.check_txs([WireTransaction(data) for data in datas])
+
+
+# The points a block spent and created.
+BlockUndo = collections.namedtuple("BlockUndo", ["txs", "spent", "created"])
+
+# Number of blocks disconnect_block can undo by default.
+MAX_UNDO = 100
+
+# Number of transactions sent to a worker at once.
+CHECK_CHUNK = 16
+# Number of blocks process_blocks checks ahead of the one it applies.
+PIPELINE_DEPTH = 4
 
 
 class Chain(object):
 
-    def __init__(self, genesis_output):
+    def __init__(self, genesis_output, store=None, executor=None):
+        """Starts a chain from genesis_output.
+
+        With a blockstore.BlockStore store, continues from the latest
+        snapshot in it and replays the blocks stored after that.
+        Accepted blocks are then appended to the store.
+
+        With a concurrent.futures executor, typically a
+        ProcessPoolExecutor, check_txs runs there, see process_blocks.
+        """
         # Do not verify the blinded genesis output point
-        self.utxo = set([genesis_output])
+        self.utxo = PointSet([genesis_output])
+        self.store = store
+        self.executor = executor
+        self.check_chunk = CHECK_CHUNK
+        self.pipeline_depth = PIPELINE_DEPTH
+        self.undo = collections.deque()
+        self.max_undo = MAX_UNDO
+        snapshot = None if store is None else store.latest_snapshot()
+        height = 0
+        if snapshot is not None:
+            self.utxo = UtxoView(SnapshotSet(snapshot))
+            height = snapshot.height
+        if store is not None:
+            blocks = (decode_block(payload) for payload in store.blocks(height))
+            for txs, checks in self._pipeline(blocks):
+                self._process_block(txs, checks=checks)
+
+    def submit_checks(self, txs):
+        """Starts check_txs on txs. Returns a function that waits for and returns its result.
+
+        With an executor, txs are sent there in their wire encoding,
+        check_chunk at a time. Otherwise they are checked right away.
+        """
+        if self.executor is None:
+            errors = self.check_txs(txs)
+            return lambda: errors
+        keys = [_cache_keys(tx) for tx in txs]
+        # Only send what is not known to be valid yet.
+        todo = [i for i, (digest, kernel) in enumerate(keys)
+                if digest not in sum_cache or kernel not in kernel_cache]
+        datas = [_encode_tx(txs[i]) for i in todo]
+        futures = [self.executor.submit(check_encoded, datas[i:i + self.check_chunk])
+                   for i in range(0, len(datas), self.check_chunk)]
+
+        def result():
+            errors = [None] * len(txs)
+            for i, error in zip(todo, sum((f.result() for f in futures), [])):
+                errors[i] = error
+            for (digest, kernel), error in zip(keys, errors):
+                if error is None:
+                    sum_cache.put(digest, True)
+                    kernel_cache.put(kernel, True)
+            return errors
+        return result
+
+    def _pipeline(self, blocks):
+        """Yields (txs, checks) for blocks, submitting checks up to pipeline_depth blocks ahead.
+
+        checks is the result of submit_checks(txs) together with the
+        instrumented work of submitting them, for _process_block.
+        """
+        pending = collections.deque()
+        for txs in blocks:
+            pending.append((txs, instrument.capture(self.submit_checks, txs)))
+            if len(pending) > self.pipeline_depth:
+                yield pending.popleft()
+        while pending:
+            yield pending.popleft()
 
     def process_tx(self, tx):
-        new_utxo = set(self.utxo)
-        for p in tx.inputs:
-            if p not in new_utxo:
-                raise InputReferenceError("Input %s not found in utxo set: %s" % (p, new_utxo))
-            new_utxo.remove(p)
+        self.process_block([tx])
+
+    def process_block(self, txs, report=False):
+        """Processes an ordered list of transactions atomically.
 
+        Transactions may spend outputs created earlier in the same
+        block. If any transaction is invalid, the utxo set is left
+        untouched. By default the first error is raised. With
+        report=True all transactions are checked and a list holding
+        None or the raised exception for each one is returned.
+
+        Accepted blocks are appended to the store, if any, and a utxo
+        snapshot is written whenever one is due.
+        """
+        return self._accept_block(txs, report)
+
+    def process_blocks(self, blocks, report=False):
+        """Processes an iterable of blocks, yielding what process_block returns for each.
+
+        The utxo independent checks of the next pipeline_depth blocks
+        run on the executor while a block is applied to the utxo set.
+        blocks is consumed lazily, so streaming a long history keeps
+        only these blocks in memory.
+        """
+        for txs, checks in self._pipeline(blocks):
+            yield self._accept_block(txs, report, checks)
+
+    def _accept_block(self, txs, report, checks=None):
+        outcomes = self._process_block(txs, report, checks)
+        if self.store is not None and all(o is None for o in outcomes):
+            self.store.append(encode_block(txs))
+            if self.store.snapshot_due():
+                self.snapshot()
+        if report:
+            return outcomes
+
+    def _process_block(self, txs, report=False, checks=None):
+        if checks is None:
+            errors = self.submit_checks(txs)()
+        else:
+            result, ops = checks
+            # The checks were submitted ahead, count them for this block.
+            instrument.charge(ops)
+            errors = result()
+        new_utxo = UtxoView(self.utxo)
+        outcomes = []
+        for tx, error in zip(txs, errors):
+            if not report:
+                self.apply_tx(new_utxo, tx, error)
+                continue
+            # Give each tx its own view so that a failing tx does not
+            # leave partial spends behind for the following ones.
+            tx_utxo = UtxoView(new_utxo)
+            try:
+                self.apply_tx(tx_utxo, tx, error)
+            except (InputReferenceError, BadSignatureError, ValueError) as e:
+                outcomes.append(e)
+                continue
+            tx_utxo.commit()
+            outcomes.append(None)
+
+        if all(o is None for o in outcomes):
+            self.undo.append(BlockUndo(txs, list(new_utxo.spent), list(new_utxo.created)))
+            if len(self.undo) > self.max_undo:
+                self.undo.popleft()
+            new_utxo.commit()
+        return outcomes
+
+    def disconnect_block(self):
+        """Undoes the last accepted block and returns its transactions.
+
+        Costs O(size of the block). Only the last max_undo blocks can
+        be disconnected. The block is removed from the store, if any.
+        """
+        if not self.undo:
+            raise IndexError("No block to disconnect")
+        block = self.undo.pop()
+        for p in block.created:
+            self.utxo.remove(p)
+        for p in block.spent:
+            self.utxo.add(p)
+        if self.store is not None:
+            self.store.pop()
+        return block.txs
+
+    def snapshot(self):
+        """Writes the utxo set to the store and continues on top of that snapshot."""
+        keys = set(self.utxo.encodings())
+        snapshot = self.store.write_snapshot(POINT_SIZE, 0, [(k, b"") for k in keys])
+        self.utxo = UtxoView(SnapshotSet(snapshot))
+
+    @staticmethod
+    def check_txs(txs):
+        """Runs the utxo independent checks on txs.
+
+        Returns a list holding None or the exception to raise for each
+        tx. All excess signatures are checked in a single batch.
+        """
         # The transaction sum should have the form: v * G + r * H with
         # v == 0, r == 0. If we would know 'r', we could check that with:
         #
@@ -95,58 +749,173 @@ class Chain(object):
         #
         # It doesn't matter what is signed, only that the signature is
         # valid. We use a constant WITNESS_MAGIC as signature message.
+        #
+        # Both checks are skipped for what sum_cache and kernel_cache
+        # already hold. Points of WireTransactions are decompressed
+        # here, and a malformed one is the error of its tx only.
+        errors = []
+        signed = []
+        kernels = []
+        items = []
+        for idx, tx in enumerate(txs):
+            digest, kernel = _cache_keys(tx)
+            try:
+                if sum_cache.get(digest) is None:
+                    if not tx.sum().isPlusID():
+                        errors.append(ValueError("tx.sum not zero"))
+                        continue
+                    sum_cache.put(digest, True)
+                if kernel_cache.get(kernel) is None:
+                    items.append((tx.signature, tx.excess, Signature.WITNESS_MAGIC))
+                    signed.append(idx)
+                    kernels.append(kernel)
+            except ValueError as e:
+                errors.append(e)
+                continue
+            errors.append(None)
+
+        invalid = set()
+        if not Signature.batch_verify(items):
+            invalid = set(Signature.find_invalid(items))
+            for bad in invalid:
+                # tx.excess was not proven to be of the form v*G + r*H with
+                # v == 0. It might have a negative 'v' and therefore
+                # the tx might have created money out of nothing. Reject.
+                errors[signed[bad]] = BadSignatureError("Invalid signature on excess.")
+        for i, kernel in enumerate(kernels):
+            if i not in invalid:
+                kernel_cache.put(kernel, True)
+        return errors
+
+    def apply_tx(self, new_utxo, tx, error=None):
+        """Validates tx against the UtxoView new_utxo and records its effects there.
+
+        error is the result of check_txs for tx, and is raised once the
+        inputs have been found in the utxo set.
+        """
+        # Points are looked up by their encodings, which WireTransactions
+        # provide without decompressing them.
+        for k in _encodings(tx.inputs):
+            if k not in new_utxo:
+                raise InputReferenceError("Input %s not found in utxo set" %
+                                          binascii.hexlify(k).decode("ascii"))
+            new_utxo.remove(k)
+
+        if error is not None:
+            raise error
+
+        new_utxo.update(_encodings(tx.outputs))
+
+
+class PoolSet(object):
+    """The utxo set of a chain together with the outputs created in a Mempool on it."""
+
+    def __init__(self, pool):
+        self.pool = pool
+
+    def __contains__(self, p):
+        k = point_key(p)
+        return k in self.pool.created_by or k in self.pool.chain.utxo
 
-        if not tx.sum().isPlusID():
-            raise ValueError("tx.sum not zero")
 
-        if not tx.signature.verify(tx.excess, Signature.WITNESS_MAGIC):
-            # tx.excess was not proven to be of the form v*G + r*H with
-            # v == 0. It might have a negative 'v' and therefore
-            # the tx might have created money out of nothing. Reject.
-            raise BadSignatureError("Invalid signature on excess.")
+class Mempool(mempool.Mempool):
+    """Mempool of Transactions or WireTransactions, keyed by the hash of their encoding.
 
-        new_utxo.update(tx.outputs)
-        self.utxo = new_utxo
+    Transactions carry no visible fee, so block templates take them in
+    arrival order and eviction drops the newest first.
+    """
+
+    def describe(self, tx):
+        data = _encode_tx(tx)
+        return (_sha256(data), _encodings(tx.inputs), _encodings(tx.outputs), len(data))
+
+    def validate(self, tx):
+        error = self.chain.check_txs([tx])[0]
+        self.chain.apply_tx(UtxoView(PoolSet(self)), tx, error)
+        return 0
 
 
 class Actor():
     """Mimblewimble actor, and wallet owner."""
 
-    def __init__(self, txs, c):
+    def __init__(self, txs, c, strategy=coinselect.select_random):
         # Set of owned outputs
-        self.wallet = set(txs)
+        self.wallet = set()
+        # Owned outputs by their commitment point
+        self.outputs = {}
+        # Commitment points of owned outputs, sorted by value. Outputs
+        # selected as inputs move to pending until found spent, and
+        # spent ones stay in outputs and wallet, but out of the index.
+        self.index = coinselect.ValueIndex()
+        self.pending = set()
+        # Default coin selection strategy, see coinselect
+        self.strategy = strategy
         self.chain = c
+        self.add_outputs(txs)
+
+    def add_outputs(self, outputs):
+        """Adds owned outputs to the wallet."""
+        outputs = [o for o in outputs if o not in self.wallet]
+        self.wallet.update(outputs)
+        points = OwnedOutput.blind_many(outputs)
+        for o, P in zip(outputs, points):
+            self.outputs[P] = o
+        self.index.update(zip(points, [o.value for o in outputs]))
 
     def generate_output(self, v):
         """Generates outputs claiming 'v' amount of coins."""
         # FIXME add more change outputs for confusion
         new_output = [OwnedOutput.generate(v)]
-        self.wallet.update(new_output)
+        self.add_outputs(new_output)
         return new_output
 
     def coins_owned(self):
         """Return the amount of coins owned by this wallet at the current chain UTXO state."""
-        return sum([t.value for t in self.wallet if (t.blind() in self.chain.utxo)])
-
-    def select_inputs(self, n):
-        """Selects inputs worth 'n', and returns change outputs."""
-        owned_outputs = []
-        candidates = set(self.wallet)
-        while sum([i.value for i in owned_outputs]) < n and candidates:
-            # FIXME add a few unrelated inputs for confusion
-            c = random.choice(list(candidates))
-            if c.blind() in self.chain.utxo:
-                owned_outputs += [c]
-            candidates.remove(c)
+        return sum([o.value for P, o in self.outputs.items() if P in self.chain.utxo])
+
+    def select_inputs(self, n, strategy=None):
+        """Selects inputs worth 'n', and returns change outputs.
+
+        strategy is a coinselect strategy function or the name of one,
+        and defaults to self.strategy.
+        """
+        if strategy is None:
+            strategy = self.strategy
+        if not callable(strategy):
+            strategy = coinselect.STRATEGIES[strategy]
+        self.prune()
+        # FIXME add a few unrelated inputs for confusion
+        selected = strategy(self.index, n, lambda P: P in self.chain.utxo)
+        owned_outputs = [self.outputs[P] for P in selected]
 
         change = sum([o.value for o in owned_outputs]) - n
         if change < 0:
             raise ValueError("Not enough coins")
+        for P in selected:
+            self.index.remove(P)
+            self.pending.add(P)
         return (owned_outputs, self.generate_output(change))
 
-    def send(self, n):
+    def release(self, tx):
+        """Makes the owned inputs of tx selectable again, after tx was dropped."""
+        for P in tx.inputs:
+            self.pending.discard(P)
+            if P in self.outputs:
+                self.index.add(P, self.outputs[P].value)
+
+    def prune(self):
+        """Stops tracking the selected outputs that have been spent on the chain."""
+        for P in [P for P in self.pending if P not in self.chain.utxo]:
+            self.pending.remove(P)
+
+    def rescan(self):
+        """Makes all owned outputs in the utxo set selectable again, e.g. after disconnect_block."""
+        self.index.update((P, o.value) for P, o in self.outputs.items()
+                          if P in self.chain.utxo and P not in self.pending)
+
+    def send(self, n, strategy=None):
         """Creates a transaction sending 'n' coins."""
-        owned_outputs, change_outputs = self.select_inputs(n)
+        owned_outputs, change_outputs = self.select_inputs(n, strategy)
 
         (t, v, r) = OwnedTransaction(inputs = owned_outputs,
                                      outputs = change_outputs).close(Signature.gen_private_key())
@@ -216,18 +985,83 @@ class Signature(collections.namedtuple("Signature", ["s", "K"])):
     def sign(cls, e, x):
         k = cls.gen_private_key()
         s = cls.nF.plus(k, cls.nF.mul(x, cls.nF.make(e)))
-        return Signature(s, cls.Hfield.make(int(k)).point)
+        return Signature(s, from_jacobian(jacobian_msm([int(k)], [_H])))
 
     @classmethod
     def merge(cls, s1, s2):
         return Signature(cls.nF.plus(s1.s, s2.s), secp256k1.plus(s1.K, s2.K))
 
+    # 32 byte s, followed by the 33 byte encoded K.
+    SIZE = 32 + POINT_SIZE
+
+    def serialize(self):
+        return encode_int(int(self.s)) + encode_point(self.K)
+
+    @classmethod
+    def unpack_from(cls, buf, offset=0):
+        buf = memoryview(buf)
+        s = decode_int(buf[offset:offset + 32].tobytes())
+        if s >= cls.Hfield.order:
+            raise ValueError("Signature scalar out of range")
+        return Signature(cls.nF.make(s), decode_point(buf[offset + 32:offset + cls.SIZE]))
+
     def verify(self, pubKey, e):
-        S = Signature.Hfield.make(int(self.s)).point
-        V = Signature.Hfield.ec.plus(self.K, pubKey.scalarMul(e))
-        return S == V
+        # s * H == K + e * pubKey
+        return curve.is_identity(jacobian_msm([int(self.s), -1, -e],
+                                              [_H, to_jacobian(self.K), to_jacobian(pubKey)]))
+
+    @classmethod
+    def batch_verify(cls, items):
+        """Verifies a list of (signature, pubKey, e) triples at once.
+
+        Checks the random linear combination
+
+          sum(a_i * s_i) * H == sum(a_i * K_i) + sum(a_i * e_i * P_i)
+
+        which holds for all valid signatures, and only with negligible
+        probability if any of them is invalid.
+        """
+        if len(items) < 2:
+            return all(sig.verify(pubKey, e) for sig, pubKey, e in items)
+        order = cls.Hfield.order
+        s = 0
+        scalars = []
+        points = []
+        for sig, pubKey, e in items:
+            # The coefficients must not be predictable by whoever
+            # crafted the signatures.
+            a = _batch_random.getrandbits(128)
+            s += a * int(sig.s)
+            scalars += [-a, -(a * e % order)]
+            points += [to_jacobian(sig.K), to_jacobian(pubKey)]
+        return curve.is_identity(jacobian_msm([s % order] + scalars, [_H] + points))
+
+    @classmethod
+    def find_invalid(cls, items):
+        """Returns the indices of the invalid triples in items, by bisecting with batch_verify."""
+        def bisect(lo, hi):
+            if cls.batch_verify(items[lo:hi]):
+                return []
+            if hi - lo == 1:
+                return [lo]
+            mid = (lo + hi) // 2
+            return bisect(lo, mid) + bisect(mid, hi)
+        return bisect(0, len(items))
 
     @classmethod
     def gen_private_key(cls):
         return cls.nF.make(random.randrange(1, Signature.Hfield.order))
 #        return cls.nF.fromInt(random.randrange(1, 30))
+
+
+instrument.register_scope(Chain, "_process_block", "block")
+instrument.register_scope(Chain, "apply_tx", "tx")
+instrument.register(__name__, "jacobian_msm", "scalar_mul", count=lambda scalars, points: len(scalars))
+instrument.register(jacobian.Curve, "plus", "point_add")
+instrument.register(jacobian.Curve, "double", "point_double")
+instrument.register(Signature, "verify", "verify")
+instrument.register(Signature, "batch_verify", "batch_verify", count=lambda cls, items: len(items))
+instrument.register(__name__, "_sha256", "hash")
+instrument.register(UtxoView, "__contains__", "utxo_lookup")
+instrument.register(UtxoView, "commit", "utxo_commit")
+instrument.register(Chain, "snapshot", "utxo_snapshot")
@@ -1,7 +1,12 @@
 #! /usr/bin/env nix-shell
-#! nix-shell -i python2 -p "with python2Packages; [python]"
+#! nix-shell -i python2 -p "with python2Packages; [python futures]"
 
 from mimblewimble_chain import *
+import blockstore
+import instrument
+import concurrent.futures
+import shutil
+import tempfile
 import unittest
 
 # Deterministic tests for the moment
@@ -47,6 +52,46 @@ class GeneratorTests(unittest.TestCase):
         self.assertTrue(secp256k1.plus(G.scalarMul(100).plusInv(), G.scalarMul(100)).isPlusID())
 
 
+    def test_msm(self):
+        scalars = [5, -7, 0, 2 ** 200 + 3]
+        points = [G, H, G, secp256k1.plus(G, H)]
+        expected = reduce(secp256k1.plus, [P.scalarMul(k) for k, P in zip(scalars, points) if k > 0],
+                          H.scalarMul(7).plusInv())
+        self.assertEqual(msm(scalars, points), expected)
+        self.assertTrue(msm([], []).isPlusID())
+
+    def test_fixed_base(self):
+        for i in range(3):
+            o = OwnedOutput.generate(random.randrange(2 ** 64))
+            self.assertEqual(o.blind(), secp256k1.plus(H.scalarMul(int(o.bf)), G.scalarMul(o.value)))
+
+    def test_commitment_cache(self):
+        o = OwnedOutput.generate(5)
+        P = o.blind()
+        self.assertTrue(o.blind() is P)
+        self.assertEqual(OwnedOutput.blind_many([OwnedOutput.generate(6), o])[1], P)
+
+    def test_jacobian_round_trip(self):
+        for P in [G, H, H.plusInv(), secp256k1.plus(G, G.plusInv())]:
+            self.assertEqual(from_jacobian(to_jacobian(P)), P)
+        # Converted points are toycrypto points like any other.
+        P = from_jacobian(to_jacobian(secp256k1.plus(G, H)))
+        self.assertEqual(secp256k1.plus(P, G.plusInv()), H)
+        self.assertEqual(G, secp256k1.fromX(G.x))
+        outputs = [OwnedOutput.generate(v) for v in [0, 1, 1000]]
+        self.assertEqual(OwnedOutput.blind_many(outputs), [o.blind() for o in outputs])
+
+    def test_point_encoding(self):
+        for P in [G, H, H.plusInv(), secp256k1.plus(G, G.plusInv())]:
+            data = encode_point(P)
+            self.assertEqual(len(data), 33)
+            self.assertEqual(decode_point(data), P)
+            self.assertEqual(decode_point(memoryview(data)), P)
+        with self.assertRaises(ValueError):
+            decode_point(b"\x04" + encode_point(G)[1:])
+        with self.assertRaises(ValueError):
+            decode_point(b"\x02" + b"\xff" * 32)
+
     def test_owned_output(self):
         self.assertEqual(G.scalarMul(100), OwnedOutput(100, Signature.nF.make(0)).blind())
         self.assertEqual(G.scalarMul(100).plusInv(), OwnedOutput(100, Signature.nF.make(0)).blind().plusInv())
@@ -54,6 +99,50 @@ class GeneratorTests(unittest.TestCase):
         excess_add = Signature.gen_private_key()
         self.assertEqual(H.scalarMul(int(excess_add.plusInv())), H.scalarMul(int(excess_add)).plusInv())
 
+class SignatureTest(unittest.TestCase):
+    def setUp(self):
+        self.items = []
+        for i in range(5):
+            x = Signature.gen_private_key()
+            self.items.append((Signature.sign(i, x), H.scalarMul(int(x)), i))
+
+    def test_batch_verify(self):
+        self.assertTrue(Signature.batch_verify(self.items))
+        self.assertEqual(Signature.find_invalid(self.items), [])
+
+    def test_find_invalid(self):
+        sig, pubKey, e = self.items[3]
+        self.items[3] = (sig, pubKey, e + 1)
+        self.assertFalse(Signature.batch_verify(self.items))
+        self.assertEqual(Signature.find_invalid(self.items), [3])
+
+class UtxoViewTest(unittest.TestCase):
+    def test_commit(self):
+        base = set([b"1", b"2"])
+        v = UtxoView(base)
+        v.remove(b"1")
+        v.update([b"3"])
+        self.assertFalse(b"1" in v)
+        self.assertTrue(b"3" in v)
+        self.assertEqual(base, set([b"1", b"2"]))
+        v.commit()
+        self.assertEqual(base, set([b"2", b"3"]))
+
+    def test_remove_twice(self):
+        v = UtxoView(set([b"1"]))
+        v.remove(b"1")
+        with self.assertRaises(KeyError):
+            v.remove(b"1")
+
+    def test_points(self):
+        v = UtxoView(PointSet([G]))
+        self.assertTrue(G in v)
+        self.assertTrue(encode_point(G) in v)
+        self.assertTrue(memoryview(encode_point(G)) in v)
+        v.add(H)
+        self.assertEqual(set(v), set([G, H]))
+        self.assertEqual(set(v.encodings()), set([encode_point(G), encode_point(H)]))
+
 class TestFoo(unittest.TestCase):
     def setUp(self):
         genesis_output = OwnedOutput.generate(1000)
@@ -88,6 +177,300 @@ class TestFoo(unittest.TestCase):
         self.assertEqual(self.clemens.coins_owned(), 0)
         self.assertEqual(self.satoshi.coins_owned(), 1000)
 
+    def test_strategies(self):
+        self.satoshi.add_outputs([OwnedOutput.generate(v) for v in [10, 20, 50]])
+        self.c.utxo.update(self.satoshi.outputs)
+        self.assertEqual(self.satoshi.coins_owned(), 1080)
+        inputs, change = self.satoshi.select_inputs(70, "branch_and_bound")
+        self.assertEqual(sum(o.value for o in inputs), 70)
+        for strategy in sorted(coinselect.STRATEGIES):
+            self.c.process_tx(self.clemens.receive(self.satoshi.send(30, strategy)))
+            self.c.process_tx(self.satoshi.receive(self.clemens.send(30, strategy)))
+        self.assertEqual(self.satoshi.coins_owned(), 1080)
+
+    def test_spent_outputs_leave_index(self):
+        for i in range(5):
+            self.c.process_tx(self.clemens.receive(self.satoshi.send(10)))
+            self.c.process_tx(self.satoshi.receive(self.clemens.send(10)))
+        self.satoshi.prune()
+        self.clemens.prune()
+        # Only the outputs still unspent remain in the index.
+        self.assertEqual(self.satoshi.pending, set())
+        self.assertEqual(set(P for P in self.satoshi.outputs if P in self.c.utxo),
+                         set(self.satoshi.index.items))
+        for P in self.clemens.index.items:
+            self.assertTrue(P in self.c.utxo)
+        self.assertEqual(self.satoshi.coins_owned(), 1000)
+
+        # Selected outputs are not selected again, unless released.
+        t = self.clemens.receive(self.satoshi.send(1000))
+        with self.assertRaises(ValueError):
+            self.satoshi.send(1000)
+        self.satoshi.release(t)
+        self.c.process_tx(self.clemens.receive(self.satoshi.send(1000)))
+        self.assertEqual(self.clemens.coins_owned(), 1000)
+
+    def test_reorg_keeps_outputs(self):
+        t = self.clemens.receive(self.satoshi.send(100))
+        self.c.process_tx(t)
+        sent = self.satoshi.receive(self.clemens.send(50))
+        self.c.disconnect_block()
+        self.clemens.prune()
+        self.assertEqual(self.clemens.coins_owned(), 0)
+        self.c.process_tx(t)
+        self.clemens.release(sent)
+        self.assertEqual(self.clemens.coins_owned(), 100)
+        self.c.process_tx(self.satoshi.receive(self.clemens.send(100)))
+        self.assertEqual(self.satoshi.coins_owned(), 1000)
+
+        # Spent outputs come back with the block spending them undone.
+        t = self.clemens.receive(self.satoshi.send(10))
+        self.c.process_tx(t)
+        self.satoshi.prune()
+        self.c.disconnect_block()
+        self.assertEqual(self.satoshi.coins_owned(), 1000)
+        self.satoshi.rescan()
+        self.c.process_tx(self.clemens.receive(self.satoshi.send(1000)))
+        self.assertEqual(self.clemens.coins_owned(), 1000)
+
+    def test_wire_format(self):
+        t = self.clemens.receive(self.satoshi.send(100))
+        data = t.serialize()
+        self.assertEqual(len(data), 8 + 33 * (len(t.inputs) + len(t.outputs) + 1) + 65)
+        self.assertEqual(Transaction.deserialize(data), t)
+
+        wt = WireTransaction(data)
+        self.assertEqual(wt.inputs.raw(0).tobytes(), encode_point(t.inputs[0]))
+        self.assertEqual(wt.inputs.points, [None] * len(t.inputs))
+        self.c.process_tx(wt)
+        self.assertEqual(self.clemens.coins_owned(), 100)
+        with self.assertRaises(ValueError):
+            WireTransaction(data[:-1])
+        with self.assertRaises(ValueError):
+            WireTransaction(data[:5])
+
+        block = encode_block([t, wt])
+        self.assertEqual([tx.buf.tobytes() for tx in decode_block(block)], [data, data])
+        for end in range(0, len(block), 7):
+            with self.assertRaises(ValueError):
+                decode_block(block[:end])
+        with self.assertRaises(ValueError):
+            decode_block(block + b"\x00")
+
+    def test_rejected_tx_leaves_utxo(self):
+        """Tests that a rejected tx neither touches the utxo set nor dumps it into the error."""
+        t = self.clemens.receive(self.satoshi.send(100))
+        self.c.process_tx(t)
+        utxo = set(self.c.utxo)
+        with self.assertRaises(InputReferenceError) as cm:
+            self.c.process_tx(t)
+        self.assertEqual(set(self.c.utxo), utxo)
+        self.assertTrue(len(str(cm.exception)) < 1000)
+
+    def test_block(self):
+        t1 = self.clemens.receive(self.satoshi.send(100))
+        # Spends clemens' output that only exists after t1.
+        o_in = list(self.clemens.wallet)[0]
+        o_out = OwnedOutput.generate(100)
+        t2, v, r = OwnedTransaction([o_in], [o_out]).close(
+            Signature.nF.plus(o_out.bf, o_in.bf.plusInv()))
+        self.satoshi.add_outputs([o_out])
+        utxo = set(self.c.utxo)
+        outcomes = self.c.process_block([t2, t1], report=True)
+        self.assertTrue(isinstance(outcomes[0], InputReferenceError))
+        self.assertEqual(outcomes[1], None)
+        self.assertEqual(set(self.c.utxo), utxo)
+
+        self.c.process_block([t1, t2])
+        self.assertEqual(self.satoshi.coins_owned(), 1000)
+        self.assertEqual(self.clemens.coins_owned(), 0)
+
+    def test_aggregate(self):
+        t1 = self.clemens.receive(self.satoshi.send(100))
+        o_in = list(self.clemens.wallet)[0]
+        o_out = OwnedOutput.generate(100)
+        t2, v, r = OwnedTransaction([o_in], [o_out]).close(
+            Signature.nF.plus(o_out.bf, o_in.bf.plusInv()))
+        self.satoshi.add_outputs([o_out])
+        t = Transaction.aggregate([t2, t1])
+        self.assertEqual(t.inputs, t1.inputs)
+        self.assertEqual(len(t.outputs), len(t1.outputs))
+        self.assertFalse(o_in.blind() in t.outputs)
+        self.assertTrue(o_out.blind() in t.outputs)
+        self.assertTrue(t.sum().isPlusID())
+        self.assertTrue(t.signature.verify(t.excess, Signature.WITNESS_MAGIC))
+        self.c.process_tx(t)
+        self.assertEqual(self.satoshi.coins_owned(), 1000)
+        self.assertEqual(self.clemens.coins_owned(), 0)
+
+    def test_bad_signature(self):
+        t = self.clemens.receive(self.satoshi.send(100))
+        bad = t._replace(signature=Signature.merge(t.signature, Signature.sign(1, Signature.gen_private_key())))
+        outcomes = self.c.process_block([bad], report=True)
+        self.assertTrue(isinstance(outcomes[0], BadSignatureError))
+        with self.assertRaises(BadSignatureError):
+            self.c.process_tx(bad)
+        self.c.process_tx(t)
+        self.assertEqual(self.clemens.coins_owned(), 100)
+
+    def test_pipeline(self):
+        blocks = []
+        for i in range(3):
+            t = self.clemens.receive(self.satoshi.send(10))
+            self.c.process_tx(t)
+            blocks.append([t])
+        t = self.clemens.receive(self.satoshi.send(10))
+        bad = t._replace(signature=Signature.merge(t.signature, Signature.sign(1, Signature.gen_private_key())))
+        with concurrent.futures.ProcessPoolExecutor(2) as executor:
+            c = Chain(self.genesis_tx.outputs[0], executor=executor)
+            c.check_chunk = 1
+            c.pipeline_depth = 2
+            wt = WireTransaction(t.serialize())
+            outcomes = list(c.process_blocks(blocks + [[bad, wt]], report=True))
+            self.assertEqual(outcomes[:3], [[None]] * 3)
+            self.assertTrue(isinstance(outcomes[3][0], BadSignatureError))
+            self.assertEqual(outcomes[3][1], None)
+            # Only the workers decompressed its points.
+            self.assertEqual(wt.inputs.points + wt.outputs.points, [None] * (len(t.inputs) + len(t.outputs)))
+            self.assertEqual(set(c.utxo), set(self.c.utxo))
+            with self.assertRaises(BadSignatureError):
+                list(c.process_blocks([[bad]]))
+            self.assertEqual(list(c.process_blocks([[t]])), [None])
+        self.c.process_tx(t)
+        self.assertEqual(set(c.utxo), set(self.c.utxo))
+
+    def test_malformed_points(self):
+        t = self.clemens.receive(self.satoshi.send(100))
+        data = t.serialize()
+        x = 1
+        while pow(x ** 3 + 7, (p - 1) // 2, p) == 1:
+            x += 1
+        off_curve = b"\x02" + encode_int(x)
+        output = 8 + 33 * len(t.inputs)
+        bad = [WireTransaction(data[:output] + off_curve + data[output + 33:]),
+               WireTransaction(data[:output] + b"\x05" + data[output + 1:]),
+               # The signature scalar s is out of range.
+               WireTransaction(data[:-65] + b"\xff" * 32 + data[-33:])]
+        utxo = set(self.c.utxo)
+        outcomes = self.c.process_block(bad + [WireTransaction(data)], report=True)
+        for o in outcomes[:3]:
+            self.assertTrue(isinstance(o, ValueError))
+        self.assertEqual(outcomes[3], None)
+        self.assertEqual(set(self.c.utxo), utxo)
+        with concurrent.futures.ProcessPoolExecutor(2) as executor:
+            c = Chain(self.genesis_tx.outputs[0], executor=executor)
+            c.check_chunk = 1
+            outcomes = list(c.process_blocks([bad + [WireTransaction(data)]], report=True))[0]
+            for o in outcomes[:3]:
+                self.assertTrue(isinstance(o, ValueError))
+            self.assertEqual(outcomes[3], None)
+            self.assertEqual(set(c.utxo), set(self.c.utxo))
+
+    def test_mempool(self):
+        pool = Mempool(self.c)
+        t1 = self.clemens.receive(self.satoshi.send(100))
+        o_in = list(self.clemens.wallet)[0]
+        o_out = OwnedOutput.generate(100)
+        t2, v, r = OwnedTransaction([o_in], [o_out]).close(
+            Signature.nF.plus(o_out.bf, o_in.bf.plusInv()))
+        self.satoshi.add_outputs([o_out])
+        with self.assertRaises(InputReferenceError):
+            pool.add(t2)
+        pool.add(WireTransaction(t1.serialize()))
+        pool.add(t2)
+        with self.assertRaises(mempool.ConflictError):
+            pool.add(t2._replace(outputs=[]))
+        bad = t1._replace(signature=Signature.merge(t1.signature, Signature.sign(1, Signature.gen_private_key())))
+        pool.remove_block([bad])
+        self.assertEqual(len(pool), 0)
+        pool.add(t1)
+        pool.add(t2)
+        block = pool.block_template()
+        # Both were checked on admission.
+        hits = (sum_cache.hits, kernel_cache.hits)
+        self.c.process_block(block)
+        self.assertEqual((sum_cache.hits, kernel_cache.hits), (hits[0] + 2, hits[1] + 2))
+        pool.remove_block(block)
+        self.assertEqual(len(pool), 0)
+        self.assertEqual(self.satoshi.coins_owned(), 1000)
+
+    def test_disconnect(self):
+        utxo = set(self.c.utxo)
+        t1 = self.clemens.receive(self.satoshi.send(100))
+        self.c.process_tx(t1)
+        after_t1 = set(self.c.utxo)
+        t2 = self.satoshi.receive(self.clemens.send(100))
+        self.c.process_tx(t2)
+        self.assertEqual(self.c.disconnect_block(), [t2])
+        self.assertEqual(set(self.c.utxo), after_t1)
+        self.assertEqual(self.c.disconnect_block(), [t1])
+        self.assertEqual(set(self.c.utxo), utxo)
+        with self.assertRaises(IndexError):
+            self.c.disconnect_block()
+        self.c.process_tx(t1)
+        self.assertEqual(self.clemens.coins_owned(), 100)
+
+    def test_instrument(self):
+        t = self.clemens.receive(self.satoshi.send(100))
+        sink = instrument.Aggregator()
+        instrument.enable(sink)
+        try:
+            self.c.process_tx(t)
+        finally:
+            instrument.disable()
+        block = sink.scopes["block"]["ops"]
+        self.assertTrue(block["scalar_mul"][0] > 0)
+        self.assertTrue(block["point_add"][0] > 0)
+        self.assertEqual(block["hash"][0], 1)
+        self.assertEqual(sink.scopes["tx"]["ops"]["utxo_lookup"][0], len(t.inputs))
+        self.assertEqual(self.clemens.coins_owned(), 100)
+
+    def test_instrument_pipeline(self):
+        blocks = []
+        for i in range(3):
+            t = self.clemens.receive(self.satoshi.send(10))
+            self.c.process_tx(t)
+            blocks.append([t])
+        c = Chain(self.genesis_tx.outputs[0])
+        c.pipeline_depth = 2
+        sink = instrument.Aggregator()
+        instrument.enable(sink)
+        try:
+            list(c.process_blocks(blocks))
+        finally:
+            instrument.disable()
+        # The checks submitted ahead are charged to their blocks.
+        self.assertFalse("unscoped" in sink.scopes)
+        self.assertEqual(sink.scopes["block"]["count"], 3)
+        self.assertEqual(sink.scopes["block"]["ops"]["hash"][0], 3)
+
+    def test_store(self):
+        d = tempfile.mkdtemp()
+        try:
+            genesis = self.genesis_tx.outputs[0]
+            store = blockstore.BlockStore(d, snapshot_interval=2, sync=False)
+            self.c = self.satoshi.chain = self.clemens.chain = Chain(genesis, store)
+            for i in range(3):
+                self.c.process_tx(self.clemens.receive(self.satoshi.send(10)))
+            self.assertEqual(store.latest_snapshot().height, 2)
+            expected = set(encode_point(p) for p in self.c.utxo)
+            store.close()
+
+            store = blockstore.BlockStore(d, snapshot_interval=2, sync=False)
+            self.c = self.satoshi.chain = self.clemens.chain = Chain(genesis, store)
+            self.assertEqual(set(encode_point(p) for p in self.c.utxo), expected)
+            self.assertEqual(self.clemens.coins_owned(), 30)
+            self.c.process_tx(self.satoshi.receive(self.clemens.send(30)))
+            self.assertEqual(store.latest_snapshot().height, 4)
+            store.close()
+
+            store = blockstore.BlockStore(d, snapshot_interval=2, sync=False)
+            self.c = self.satoshi.chain = Chain(genesis, store)
+            self.assertEqual(self.satoshi.coins_owned(), 1000)
+            store.close()
+        finally:
+            shutil.rmtree(d)
+
     # FIXME add malicious receivers as discussed in Actor.receive comments.
 
     def xtest_input_txid_error(self):
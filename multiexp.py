@@ -0,0 +1,342 @@
+"""Multi-scalar multiplication.
+
+Computes sum(k_i * P_i) in one pass instead of one scalar
+multiplication per term followed by a chain of additions.
+
+The functions work over any additive group, given as an object with:
+
+  identity      the neutral element
+  plus(a, b)    group addition
+  double(a)     plus(a, a)
+  neg(a)        additive inverse
+
+and optionally normalize(points), returning equal points that are
+cheaper to add, like affine points for Jacobian coordinates.
+
+Scalars are Python ints. Negative scalars are handled by negating the
+point, and callers reduce scalars modulo the group order where needed.
+"""
+
+import binascii
+import hashlib
+import os
+import random
+import struct
+
+# Below this many terms interleaved wNAF (Strauss) wins, above it the
+# bucket method (Pippenger) does.
+PIPPENGER_THRESHOLD = 128
+
+
+def _add(group, a, b):
+    # None stands for the identity, so that the group never has to
+    # add or double its neutral element.
+    if a is None:
+        return b
+    if b is None:
+        return a
+    return group.plus(a, b)
+
+
+def _normalize(group, points):
+    normalize = getattr(group, "normalize", None)
+    if normalize is None:
+        return points
+    return normalize(points)
+
+
+def _result(group, acc):
+    if acc is None:
+        return group.identity
+    return acc
+
+
+def _terms(group, scalars, points):
+    terms = []
+    for k, P in zip(scalars, points):
+        if k < 0:
+            k, P = -k, group.neg(P)
+        if k:
+            terms.append((k, P))
+    return terms
+
+
+def multiply(group, scalars, points, fixed=None):
+    """Returns sum(k * P for k, P in zip(scalars, points)).
+
+    fixed optionally maps base points to their FixedBaseTable. Terms
+    with such a base are computed from the table.
+    """
+    acc = None
+    if fixed:
+        rest = []
+        for k, P in zip(scalars, points):
+            table = fixed.get(P)
+            if table is not None and abs(k).bit_length() <= table.bits:
+                R = table.multiply(abs(k))
+                if R is not None and k < 0:
+                    R = group.neg(R)
+                acc = _add(group, acc, R)
+            else:
+                rest.append((k, P))
+        scalars = [k for k, P in rest]
+        points = [P for k, P in rest]
+
+    terms = _terms(group, scalars, points)
+    if len(terms) < PIPPENGER_THRESHOLD:
+        return _result(group, _add(group, acc, strauss(group, terms)))
+    return _result(group, _add(group, acc, pippenger(group, terms)))
+
+
+_spot_random = random.SystemRandom()
+
+
+class FixedBaseTable(object):
+    """Precomputed multiples of a fixed base point B.
+
+    Row i holds j * 2^(w*i) * B for j = 1 .. 2^w - 1, so k * B is the
+    sum of one entry per w bit digit of k, without any doublings. The
+    rows are built on first use. If path is given, they are loaded from
+    there when present, and saved there after building.
+
+    Points must be non-negative ints or tuples of them, like the
+    points of jacobian.Curve. Files hold their coordinates in a fixed
+    size binary format followed by a sha256 checksum. Loading checks
+    the checksum and a few rows against the group operations, and
+    ignores files that fail.
+    """
+
+    # Magic, bits, w, coordinates per point and bytes per coordinate.
+    HEADER = struct.Struct(">4sHHHH")
+    MAGIC = b"FBT1"
+    # Number of randomly chosen entries recomputed on load.
+    SPOT_CHECKS = 8
+
+    def __init__(self, group, base, bits=256, w=6, path=None):
+        self.group = group
+        self.base = base
+        self.bits = bits
+        self.w = w
+        self.path = path
+        self._rows = None
+
+    @property
+    def rows(self):
+        if self._rows is None:
+            self._rows = self.load()
+            if self._rows is None:
+                self._rows = self.build()
+                if self.path is not None:
+                    self.save()
+        return self._rows
+
+    def build(self):
+        group = self.group
+        rows = []
+        B = self.base
+        for i in range((self.bits + self.w - 1) // self.w):
+            row = [B]
+            for j in range(2, 1 << self.w):
+                row.append(group.plus(row[-1], B))
+            rows.append(row)
+            # 2^w * B, the base of the next row.
+            B = group.plus(row[-1], B)
+        flat = _normalize(group, [P for row in rows for P in row])
+        n = (1 << self.w) - 1
+        return [flat[i:i + n] for i in range(0, len(flat), n)]
+
+    def _coords(self, P):
+        return tuple(P) if isinstance(P, tuple) else (P,)
+
+    def _point(self, coords):
+        return coords if isinstance(self.base, tuple) else coords[0]
+
+    def _rows_count(self):
+        return (self.bits + self.w - 1) // self.w
+
+    def load(self):
+        """Returns the rows stored at path, or None if there are none for this table."""
+        if self.path is None or not os.path.exists(self.path):
+            return None
+        try:
+            with open(self.path, "rb") as f:
+                data = f.read()
+        except (IOError, OSError):
+            return None
+        if len(data) < self.HEADER.size + 32 or hashlib.sha256(data[:-32]).digest() != data[-32:]:
+            return None
+        magic, bits, w, n_coords, size = self.HEADER.unpack_from(data, 0)
+        n = (1 << self.w) - 1
+        if (magic, bits, w, n_coords) != (self.MAGIC, self.bits, self.w, len(self._coords(self.base))):
+            return None
+        if len(data) != self.HEADER.size + (1 + self._rows_count() * n) * n_coords * size + 32:
+            return None
+        offset = self.HEADER.size
+        points = []
+        for i in range(1 + self._rows_count() * n):
+            coords = []
+            for c in range(n_coords):
+                coords.append(int(binascii.hexlify(data[offset:offset + size]), 16))
+                offset += size
+            points.append(self._point(tuple(coords)))
+        if points[0] != self.base:
+            return None
+        rows = [points[i:i + n] for i in range(1, len(points), n)]
+        if not self._spot_check(rows):
+            return None
+        return rows
+
+    def _spot_check(self, rows):
+        """Recomputes a few random entries of rows from their neighbours."""
+        group = self.group
+        n = len(rows[0])
+        checks = [(0, 0)] + [(_spot_random.randrange(len(rows)), _spot_random.randrange(n))
+                             for i in range(self.SPOT_CHECKS)]
+        for i, j in checks:
+            if j > 0:
+                # j+1 times the row base from j times it.
+                expected = group.plus(rows[i][j - 1], rows[i][0])
+            elif i > 0:
+                # 2^w times the previous row base.
+                expected = group.plus(rows[i - 1][-1], rows[i - 1][0])
+            else:
+                expected = self.base
+            if _normalize(group, [expected])[0] != rows[i][j]:
+                return False
+        return True
+
+    def save(self):
+        """Writes the rows to path. Returns whether that worked, the file is only a cache."""
+        coords = [self._coords(self.base)] + [self._coords(P) for row in self.rows for P in row]
+        size = max(1, (max(max(c) for c in coords).bit_length() + 7) // 8)
+        parts = [self.HEADER.pack(self.MAGIC, self.bits, self.w, len(coords[0]), size)]
+        parts += [binascii.unhexlify("%0*x" % (2 * size, v)) for c in coords for v in c]
+        data = b"".join(parts)
+        # Write to a temporary file first, so that a concurrent or
+        # crashed process never leaves a partial table behind.
+        tmp = "%s.%d.tmp" % (self.path, os.getpid())
+        try:
+            with open(tmp, "wb") as f:
+                f.write(data + hashlib.sha256(data).digest())
+            os.rename(tmp, self.path)
+        except (IOError, OSError):
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            return False
+        return True
+
+    def multiply(self, k):
+        """Returns k * B for 0 <= k < 2^bits, or None if k is zero."""
+        mask = (1 << self.w) - 1
+        acc = None
+        for row in self.rows:
+            if not k:
+                break
+            d = k & mask
+            if d:
+                acc = _add(self.group, acc, row[d - 1])
+            k >>= self.w
+        return acc
+
+
+def wnaf(k, w):
+    """Returns the width-w non adjacent form of k >= 0, least significant digit first.
+
+    Every non-zero digit is odd and smaller than 2^(w-1) in absolute
+    value, and of any w consecutive digits at most one is non-zero.
+    """
+    digits = []
+    while k:
+        if k & 1:
+            d = k & ((1 << w) - 1)
+            if d >= 1 << (w - 1):
+                d -= 1 << w
+            k -= d
+        else:
+            d = 0
+        digits.append(d)
+        k >>= 1
+    return digits
+
+
+def _window(n_bits):
+    # Trades the 2^(w-2) table additions against fewer additions
+    # while scanning, roughly n_bits / (w + 1).
+    if n_bits < 16:
+        return 2
+    if n_bits < 64:
+        return 3
+    if n_bits < 192:
+        return 4
+    return 5
+
+
+def strauss(group, terms):
+    """Interleaved wNAF multiplication of [(k, P), ...] with k > 0.
+
+    Returns None for the empty sum.
+    """
+    if not terms:
+        return None
+    tables = []
+    nafs = []
+    for k, P in terms:
+        w = _window(k.bit_length())
+        # Odd multiples P, 3P, 5P, ... (2^(w-1) - 1)P
+        table = [P]
+        if w > 2:
+            P2 = group.double(P)
+            for i in range(1, 1 << (w - 2)):
+                table.append(group.plus(table[-1], P2))
+        tables.append(table)
+        nafs.append(wnaf(k, w))
+    # One shared normalization for all tables.
+    flat = _normalize(group, [P for table in tables for P in table])
+    i = 0
+    for table in tables:
+        table[:] = flat[i:i + len(table)]
+        i += len(table)
+
+    acc = None
+    for i in range(max(len(naf) for naf in nafs) - 1, -1, -1):
+        if acc is not None:
+            acc = group.double(acc)
+        for table, naf in zip(tables, nafs):
+            if i < len(naf) and naf[i]:
+                d = naf[i]
+                if d > 0:
+                    acc = _add(group, acc, table[d >> 1])
+                else:
+                    acc = _add(group, acc, group.neg(table[-d >> 1]))
+    return acc
+
+
+def pippenger(group, terms):
+    """Bucket method multiplication of [(k, P), ...] with k > 0.
+
+    Returns None for the empty sum.
+    """
+    if not terms:
+        return None
+    c = max(1, len(terms).bit_length() - 2)
+    mask = (1 << c) - 1
+    n_bits = max(k.bit_length() for k, P in terms)
+
+    acc = None
+    for shift in range((n_bits - 1) // c * c, -1, -c):
+        if acc is not None:
+            for i in range(c):
+                acc = group.double(acc)
+        buckets = [None] * (mask + 1)
+        for k, P in terms:
+            d = (k >> shift) & mask
+            if d:
+                buckets[d] = _add(group, buckets[d], P)
+        # sum(j * buckets[j]) via running sums from the top bucket down.
+        running = None
+        window = None
+        for j in range(mask, 0, -1):
+            running = _add(group, running, buckets[j])
+            window = _add(group, window, running)
+        acc = _add(group, acc, window)
+    return acc
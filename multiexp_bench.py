@@ -0,0 +1,35 @@
+#! /usr/bin/env nix-shell
+#! nix-shell -i python2 -p "with python2Packages; [python]"
+
+"""Compares msm against one scalarMul per term and a reduce over secp256k1.plus."""
+
+import random
+import sys
+import timeit
+
+from mimblewimble_chain import *
+
+
+def naive(scalars, points):
+    return reduce(secp256k1.plus, [P.scalarMul(k) for k, P in zip(scalars, points)])
+
+
+def bench(f, scalars, points):
+    start = timeit.default_timer()
+    f(scalars, points)
+    return timeit.default_timer() - start
+
+
+def main(argv):
+    sizes = [int(a) for a in argv[1:]] or [2, 16, 256, 4096]
+    order = Signature.Hfield.order
+    for n in sizes:
+        scalars = [random.randrange(1, order) for i in range(n)]
+        points = [H.scalarMul(random.randrange(1, order)) for i in range(n)]
+        t_naive = bench(naive, scalars, points)
+        t_msm = bench(msm, scalars, points)
+        print("n=%-5d naive %9.3f s  msm %9.3f s  speedup %5.1fx" % (n, t_naive, t_msm, t_naive / t_msm))
+
+
+if __name__ == '__main__':
+    main(sys.argv)
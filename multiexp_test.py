@@ -0,0 +1,116 @@
+#! /usr/bin/env nix-shell
+#! nix-shell -i python2 -p "with python2Packages; [python]"
+
+from multiexp import *
+import os
+import random
+import shutil
+import tempfile
+import unittest
+
+random.seed(70)
+
+
+class ZGroup(object):
+    """Integers modulo q under addition, where sum(k * P) is easy to check."""
+    q = 2 ** 255 - 19
+    identity = 0
+
+    def plus(self, a, b):
+        return (a + b) % self.q
+
+    def double(self, a):
+        return 2 * a % self.q
+
+    def neg(self, a):
+        return -a % self.q
+
+
+class MultiexpTest(unittest.TestCase):
+    def setUp(self):
+        self.group = ZGroup()
+
+    def check(self, f, n, bits=256):
+        scalars = [random.randrange(-2 ** bits, 2 ** bits) for i in range(n)]
+        points = [random.randrange(1, self.group.q) for i in range(n)]
+        expected = sum(k * P for k, P in zip(scalars, points)) % self.group.q
+        self.assertEqual(f(self.group, scalars, points), expected)
+
+    def test_multiply(self):
+        for n in [0, 1, 2, 16, 300]:
+            self.check(multiply, n)
+
+    def test_small_scalars(self):
+        for bits in [1, 4, 20, 100]:
+            self.check(multiply, 10, bits)
+            self.check(multiply, 200, bits)
+
+    def test_strauss_pippenger(self):
+        for f in [strauss, pippenger]:
+            for n in [1, 3, 40]:
+                scalars = [random.randrange(1, 2 ** 256) for i in range(n)]
+                points = [random.randrange(1, self.group.q) for i in range(n)]
+                expected = sum(k * P for k, P in zip(scalars, points)) % self.group.q
+                self.assertEqual(f(self.group, list(zip(scalars, points))), expected)
+            self.assertEqual(f(self.group, []), None)
+
+    def test_zero(self):
+        self.assertEqual(multiply(self.group, [0, 0], [5, 7]), 0)
+
+    def test_fixed(self):
+        table = FixedBaseTable(self.group, 5, w=4)
+        fixed = {5: table}
+        for k in [1, 15, 16, 2 ** 256 - 1, random.randrange(2 ** 256)]:
+            self.assertEqual(table.multiply(k), k * 5 % self.group.q)
+            self.assertEqual(multiply(self.group, [k, -k, 3], [5, 7, 5], fixed),
+                             (k * 5 - k * 7 + 15) % self.group.q)
+        self.assertEqual(table.multiply(0), None)
+        # Scalars wider than the table fall back to the generic path.
+        self.assertEqual(multiply(self.group, [2 ** 300], [5], fixed), 2 ** 300 * 5 % self.group.q)
+
+    def test_fixed_persist(self):
+        d = tempfile.mkdtemp()
+        try:
+            path = os.path.join(d, "table")
+            rows = FixedBaseTable(self.group, 5, path=path).rows
+            self.assertTrue(os.path.exists(path))
+            self.assertEqual(FixedBaseTable(self.group, 5, path=path).load(), rows)
+            # A table for a different base ignores the file.
+            self.assertEqual(FixedBaseTable(self.group, 6, path=path).load(), None)
+            with open(path, "rb") as f:
+                data = f.read()
+            # A flipped bit fails the checksum.
+            with open(path, "wb") as f:
+                f.write(data[:100] + bytes(bytearray([bytearray(data)[100] ^ 1])) + data[101:])
+            self.assertEqual(FixedBaseTable(self.group, 5, path=path).load(), None)
+            # A wrong entry with a matching checksum fails the spot checks.
+            table = FixedBaseTable(self.group, 5, path=path)
+            table._rows = [list(row) for row in rows]
+            table._rows[3][7] += 1
+            table.save()
+            table = FixedBaseTable(self.group, 5, path=path)
+            table.SPOT_CHECKS = 10000
+            self.assertEqual(table.load(), None)
+        finally:
+            shutil.rmtree(d)
+
+    def test_fixed_unwritable(self):
+        d = tempfile.mkdtemp()
+        try:
+            table = FixedBaseTable(self.group, 5, path=os.path.join(d, "missing", "table"))
+            self.assertEqual(table.multiply(3), 15)
+            self.assertFalse(table.save())
+        finally:
+            shutil.rmtree(d)
+
+    def test_wnaf(self):
+        for w in [2, 3, 4, 5]:
+            for k in [1, 2, 7, 255, random.randrange(2 ** 256)]:
+                digits = wnaf(k, w)
+                self.assertEqual(sum(d << i for i, d in enumerate(digits)), k)
+                for d in digits:
+                    self.assertTrue(d == 0 or (d % 2 and abs(d) < 2 ** (w - 1)))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,124 @@
+"""Hash table of fixed-size byte string keys and values, packed into arrays.
+
+Records are key + value bytes, stored back to back in a single
+bytearray, so there is no per-entry object overhead. An open addressing
+index with linear probing maps keys to record numbers. It is an array
+of 4 byte ints, kept at most MAX_LOAD full. Removing a record moves the
+last record into its place, and entries of the index are shifted back
+instead of leaving tombstones, so both arrays stay dense.
+"""
+
+import array
+
+EMPTY = -1
+MAX_LOAD = 0.7
+
+
+class PackedTable(object):
+
+    def __init__(self, key_size, value_size, capacity=0):
+        self.key_size = key_size
+        self.value_size = value_size
+        self.record_size = key_size + value_size
+        self.records = bytearray()
+        self.count = 0
+        size = 8
+        while size * MAX_LOAD < capacity:
+            size *= 2
+        self.index = array.array("i", [EMPTY]) * size
+
+    def __len__(self):
+        return self.count
+
+    def memory(self):
+        """Returns the bytes taken by the records and the index."""
+        return len(self.records) + len(self.index) * self.index.itemsize
+
+    def _key(self, r):
+        start = r * self.record_size
+        return bytes(self.records[start:start + self.key_size])
+
+    def _slot(self, key):
+        """Returns the index slot holding key, or the empty slot where it would go."""
+        mask = len(self.index) - 1
+        i = hash(key) & mask
+        while True:
+            r = self.index[i]
+            if r == EMPTY or self._key(r) == key:
+                return i
+            i = (i + 1) & mask
+
+    def __contains__(self, key):
+        return self.index[self._slot(key)] != EMPTY
+
+    def get(self, key, default=None):
+        r = self.index[self._slot(key)]
+        if r == EMPTY:
+            return default
+        start = r * self.record_size + self.key_size
+        return bytes(self.records[start:start + self.value_size])
+
+    def put(self, key, value):
+        if len(key) != self.key_size or len(value) != self.value_size:
+            raise ValueError("Record must have %d + %d bytes" % (self.key_size, self.value_size))
+        i = self._slot(key)
+        r = self.index[i]
+        if r != EMPTY:
+            start = r * self.record_size + self.key_size
+            self.records[start:start + self.value_size] = value
+            return
+        self.index[i] = self.count
+        self.records += key
+        self.records += value
+        self.count += 1
+        if self.count > len(self.index) * MAX_LOAD:
+            self._resize(2 * len(self.index))
+
+    def remove(self, key):
+        """Removes key. Returns whether it was present."""
+        i = self._slot(key)
+        r = self.index[i]
+        if r == EMPTY:
+            return False
+        self._delete_slot(i)
+        last = self.count - 1
+        if r != last:
+            # Move the last record into the gap.
+            size = self.record_size
+            self.records[r * size:(r + 1) * size] = self.records[last * size:]
+            self.index[self._slot(self._key(r))] = r
+        del self.records[last * self.record_size:]
+        self.count = last
+        return True
+
+    def _delete_slot(self, i):
+        # Shift back the entries after i that could no longer be found
+        # once i is empty (Knuth's algorithm R).
+        mask = len(self.index) - 1
+        j = i
+        while True:
+            j = (j + 1) & mask
+            r = self.index[j]
+            if r == EMPTY:
+                break
+            h = hash(self._key(r)) & mask
+            if (i < j and (h <= i or h > j)) or (i > j and h <= i and h > j):
+                self.index[i] = r
+                i = j
+        self.index[i] = EMPTY
+
+    def _resize(self, size):
+        self.index = array.array("i", [EMPTY]) * size
+        mask = size - 1
+        for r in range(self.count):
+            i = hash(self._key(r)) & mask
+            while self.index[i] != EMPTY:
+                i = (i + 1) & mask
+            self.index[i] = r
+
+    def items(self):
+        size = self.record_size
+        for r in range(self.count):
+            start = r * size
+            yield (bytes(self.records[start:start + self.key_size]),
+                   bytes(self.records[start + self.key_size:start + size]))
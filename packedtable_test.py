@@ -0,0 +1,47 @@
+#! /usr/bin/env nix-shell
+#! nix-shell -i python2 -p "with python2Packages; [python]"
+
+from packedtable import *
+import random
+import unittest
+
+random.seed(70)
+
+
+class PackedTableTest(unittest.TestCase):
+    def test_put_get(self):
+        t = PackedTable(2, 1)
+        t.put(b"ab", b"1")
+        t.put(b"cd", b"2")
+        t.put(b"ab", b"3")
+        self.assertEqual(len(t), 2)
+        self.assertEqual(t.get(b"ab"), b"3")
+        self.assertEqual(t.get(b"xx"), None)
+        self.assertTrue(b"cd" in t)
+        self.assertEqual(sorted(t.items()), [(b"ab", b"3"), (b"cd", b"2")])
+        with self.assertRaises(ValueError):
+            t.put(b"abc", b"1")
+
+    def test_against_dict(self):
+        """Mixes puts and removes on a small key space, which makes long probe chains."""
+        t = PackedTable(4, 4)
+        d = {}
+        keys = [("%04d" % i).encode() for i in range(300)]
+        for n in range(5000):
+            key = random.choice(keys)
+            if random.random() < 0.45:
+                self.assertEqual(t.remove(key), key in d)
+                d.pop(key, None)
+            else:
+                value = ("%04d" % n).encode()
+                t.put(key, value)
+                d[key] = value
+        self.assertEqual(len(t), len(d))
+        self.assertEqual(dict(t.items()), d)
+        for key in keys:
+            self.assertEqual(t.get(key), d.get(key))
+        self.assertEqual(len(t.records), len(d) * 8)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,257 @@
+#! /usr/bin/env nix-shell
+#! nix-shell -i python3 -p "with python3Packages; [python ed25519]"
+
+"""Asyncio service accepting serialized transactions on a unix socket.
+
+Needs python 3. Clients send frames of a 4 byte length followed by an
+encoded transaction, see decode_basic and decode_mimblewimble. Each
+frame is answered with a frame holding a status byte, OK or REJECTED,
+followed by an error message for rejected transactions. Answers come
+in the order of the requests on each connection. A frame that is too
+large or cut off by the end of the stream is rejected as well, and
+ends the connection once the earlier requests are answered.
+
+Incoming transactions are queued and coalesced into micro-batches of
+at most max_batch transactions, or whatever arrived within max_delay
+seconds of the first one. Each batch is processed as a block, on a
+worker thread so that the event loop keeps serving clients. Payloads
+are decoded on the default executor of the loop for the same reason. Give the
+chain an executor to verify in parallel on other cores. The queue holds
+at most max_pending transactions, and each connection has at most
+max_inflight unanswered ones. Beyond that, reading from the socket
+pauses, which pushes back on the submitters.
+"""
+
+import asyncio
+import concurrent.futures
+import struct
+
+FRAME = struct.Struct(">I")
+# The largest transaction accepted, in encoded bytes. That is about
+# 3000 mimblewimble points, or 1000 basic_chain inputs.
+MAX_FRAME = 100000
+OK = b"\x00"
+REJECTED = b"\x01"
+
+
+def decode_basic(payload):
+    """Decodes a basic_chain (tx, witnesses) pair, encoded as a block of one."""
+    import basic_chain
+    txs = basic_chain.decode_block(payload)
+    if len(txs) != 1:
+        raise ValueError("Expected a single transaction, got %d" % len(txs))
+    return txs[0]
+
+
+def decode_mimblewimble(payload):
+    """Decodes a mimblewimble_chain transaction in its wire format, decompressing all points."""
+    import mimblewimble_chain
+    tx = mimblewimble_chain.WireTransaction(bytes(payload))
+    # Decompressed points are kept, so the chain does not decode them again.
+    tx.decode()
+    return tx
+
+
+def _error(e):
+    return REJECTED + ("%s: %s" % (type(e).__name__, e)).encode("utf-8")
+
+
+async def read_frame(reader):
+    """Returns the payload of the next frame, or None at the end of the stream.
+
+    Raises ValueError for a frame that is too large or cut off.
+    """
+    try:
+        header = await reader.readexactly(FRAME.size)
+    except asyncio.IncompleteReadError as e:
+        if e.partial:
+            raise ValueError("Stream ends within a frame header")
+        return None
+    length = FRAME.unpack(header)[0]
+    if length > MAX_FRAME:
+        raise ValueError("Frame of %d bytes is too large" % length)
+    try:
+        return await reader.readexactly(length)
+    except asyncio.IncompleteReadError:
+        raise ValueError("Stream ends within a frame of %d bytes" % length)
+
+
+def write_frame(writer, payload):
+    writer.write(FRAME.pack(len(payload)) + payload)
+
+
+class Service(object):
+
+    def __init__(self, chain, decode, max_batch=256, max_delay=0.005, max_pending=4096, max_inflight=256):
+        self.chain = chain
+        self.decode = decode
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.max_pending = max_pending
+        self.max_inflight = max_inflight
+        # Chains are not thread safe, all batches go through this one thread.
+        self.worker = concurrent.futures.ThreadPoolExecutor(1)
+        self.queue = None
+        self.batches = 0
+        self.connections = set()
+
+    def process(self, txs):
+        """Processes txs as a block, leaving out the invalid ones. Returns the outcomes."""
+        try:
+            outcomes = self.chain.process_block(txs, report=True)
+        except Exception:
+            # Report mode returns the errors the chain expects. Anything
+            # else is blamed on the tx that raises it when processed alone.
+            return [self._process_one(tx) for tx in txs]
+        if any(o is not None for o in outcomes):
+            # The outcome of each tx assumed the failing ones to be left
+            # out, so the valid ones make up a valid block.
+            valid = [tx for tx, o in zip(txs, outcomes) if o is None]
+            if valid:
+                self.chain.process_block(valid)
+        return outcomes
+
+    def _process_one(self, tx):
+        try:
+            return self.chain.process_block([tx], report=True)[0]
+        except Exception as e:
+            return e
+
+    async def _next_batch(self):
+        batch = [await self.queue.get()]
+        deadline = asyncio.get_running_loop().time() + self.max_delay
+        while len(batch) < self.max_batch:
+            timeout = deadline - asyncio.get_running_loop().time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def run_batches(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = await self._next_batch()
+            try:
+                outcomes = await loop.run_in_executor(self.worker, self.process, [tx for tx, f in batch])
+            except Exception as e:
+                outcomes = [e] * len(batch)
+            self.batches += 1
+            for (tx, f), outcome in zip(batch, outcomes):
+                if not f.done():
+                    f.set_result(OK if outcome is None else _error(outcome))
+
+    async def handle(self, reader, writer):
+        """Serves one client connection."""
+        loop = asyncio.get_running_loop()
+        self.connections.add(asyncio.current_task())
+        answers = asyncio.Queue(self.max_inflight)
+
+        async def answer():
+            connected = True
+            while True:
+                f = await answers.get()
+                if f is None:
+                    break
+                result = await f
+                if not connected:
+                    # Keep taking answers, so that queueing them never blocks.
+                    continue
+                try:
+                    write_frame(writer, result)
+                    await writer.drain()
+                except ConnectionError:
+                    connected = False
+
+        answering = loop.create_task(answer())
+        try:
+            while True:
+                try:
+                    payload = await read_frame(reader)
+                except ValueError as e:
+                    # The stream cannot be followed past this frame.
+                    f = loop.create_future()
+                    f.set_result(_error(e))
+                    await answers.put(f)
+                    break
+                except ConnectionError:
+                    break
+                if payload is None:
+                    break
+                f = loop.create_future()
+                await answers.put(f)
+                try:
+                    tx = await loop.run_in_executor(None, self.decode, payload)
+                except Exception as e:
+                    f.set_result(_error(e))
+                    continue
+                await self.queue.put((tx, f))
+            await answers.put(None)
+            await answering
+        except asyncio.CancelledError:
+            # serve() cancels the connections when shutting down, and the
+            # stream callback of python 3.11 logs handlers ending cancelled.
+            pass
+        finally:
+            answering.cancel()
+            writer.close()
+            self.connections.discard(asyncio.current_task())
+
+    async def serve(self, path):
+        """Serves on the unix socket path until cancelled."""
+        self.queue = asyncio.Queue(self.max_pending)
+        batches = asyncio.get_running_loop().create_task(self.run_batches())
+        server = await asyncio.start_unix_server(self.handle, path)
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            tasks = [batches] + list(self.connections)
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            self.worker.shutdown()
+
+
+class Client(object):
+    """Submits encoded transactions to a Service and awaits the answers."""
+
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+
+    @classmethod
+    async def connect(cls, path):
+        reader, writer = await asyncio.open_unix_connection(path)
+        return cls(reader, writer)
+
+    async def submit_many(self, payloads):
+        """Sends all payloads, then returns their answers as (accepted, error message) pairs.
+
+        Raises ConnectionError if the service closes the connection
+        before answering all of them, as it does after a bad frame.
+        """
+        async def send():
+            for payload in payloads:
+                write_frame(self.writer, payload)
+                await self.writer.drain()
+
+        sending = asyncio.get_running_loop().create_task(send())
+        answers = []
+        for i in range(len(payloads)):
+            answer = await read_frame(self.reader)
+            if answer is None:
+                sending.cancel()
+                raise ConnectionError("Service closed the connection after %d of %d answers"
+                                      % (i, len(payloads)))
+            answers.append((answer[:1] == OK, answer[1:].decode("utf-8")))
+        await sending
+        return answers
+
+    async def submit(self, payload):
+        return (await self.submit_many([payload]))[0]
+
+    def close(self):
+        self.writer.close()
@@ -0,0 +1,166 @@
+#! /usr/bin/env nix-shell
+#! nix-shell -i python3 -p "with python3Packages; [python ed25519]"
+
+from service import *
+import basic_chain
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+try:
+    import mimblewimble_chain
+except ImportError:
+    mimblewimble_chain = None
+
+
+class ServiceTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, "chain.sock")
+        self.priv, self.pub = basic_chain.new_key()
+        self.genesis_tx = basic_chain.Transaction(
+            [], [basic_chain.Output(pub_key=self.pub, amount=10) for i in range(40)])
+        self.chain = basic_chain.Chain(self.genesis_tx)
+        self.service = Service(self.chain, decode_basic, max_batch=16, max_delay=0.05, max_pending=8)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def spend(self, index, amount=10):
+        tx = basic_chain.Transaction([basic_chain.Input(self.genesis_tx.tx_id(), index)],
+                                     [basic_chain.Output(pub_key=self.pub, amount=amount)])
+        return basic_chain.encode_block([(tx, tx.make_witness([self.priv]))])
+
+    async def serving(self, f):
+        """Returns what f() returns while self.service serves."""
+        server = asyncio.get_running_loop().create_task(self.service.serve(self.path))
+        while not os.path.exists(self.path):
+            await asyncio.sleep(0.001)
+        try:
+            return await f()
+        finally:
+            server.cancel()
+            try:
+                await server
+            except asyncio.CancelledError:
+                pass
+            if os.path.exists(self.path):
+                os.remove(self.path)
+
+    async def run_clients(self, submissions):
+        async def submit():
+            clients = [await Client.connect(self.path) for s in submissions]
+            try:
+                return await asyncio.gather(*[c.submit_many(s) for c, s in zip(clients, submissions)])
+            finally:
+                for c in clients:
+                    c.close()
+        return await self.serving(submit)
+
+    def test_submit(self):
+        submissions = [[self.spend(i) for i in range(c, 40, 4)] for c in range(4)]
+        # Spends genesis output 0 again, pays too much, and is garbage.
+        submissions[1] += [self.spend(0), self.spend(1, amount=11), b"garbage"]
+        answers = asyncio.run(self.run_clients(submissions))
+        for a in answers[:1] + answers[2:]:
+            self.assertEqual(a, [(True, "")] * 10)
+        self.assertEqual(answers[1][:10], [(True, "")] * 10)
+        self.assertFalse(answers[1][10][0])
+        self.assertTrue(answers[1][10][1].startswith("InputReferenceError"))
+        self.assertTrue(answers[1][11][1].startswith("InputReferenceError") or
+                        answers[1][11][1].startswith("ValueError"))
+        self.assertFalse(answers[1][12][0])
+        self.assertEqual(len(self.chain.utxo), 40)
+        self.assertFalse((self.genesis_tx.tx_id(), 0) in self.chain.utxo)
+        # Transactions were validated in batches.
+        self.assertTrue(self.service.batches < 40)
+
+    def test_rejected_in_batch(self):
+        """A rejected tx does not take down the valid ones batched with it."""
+        answers = asyncio.run(self.run_clients([[self.spend(0, amount=11), self.spend(1), self.spend(2)]]))
+        self.assertEqual([accepted for accepted, error in answers[0]], [False, True, True])
+        self.assertTrue((self.genesis_tx.tx_id(), 0) in self.chain.utxo)
+        self.assertFalse((self.genesis_tx.tx_id(), 1) in self.chain.utxo)
+
+    def test_unexpected_error(self):
+        """An error the chain does not report only rejects the tx raising it."""
+        tx, witnesses = basic_chain.decode_block(self.spend(1))[0]
+        short = (tx, [witnesses[0][:54]])
+        valid = basic_chain.decode_block(self.spend(0))[0]
+        outcomes = self.service.process([short, valid])
+        self.assertNotEqual(outcomes[0], None)
+        self.assertEqual(outcomes[1], None)
+        self.assertFalse((self.genesis_tx.tx_id(), 0) in self.chain.utxo)
+        self.assertTrue((self.genesis_tx.tx_id(), 1) in self.chain.utxo)
+
+    def test_decode_off_loop(self):
+        threads = []
+
+        def decode(payload):
+            threads.append(threading.current_thread())
+            return decode_basic(payload)
+        self.service = Service(self.chain, decode)
+        answers = asyncio.run(self.run_clients([[self.spend(0), self.spend(1)]]))
+        self.assertEqual(answers, [[(True, ""), (True, "")]])
+        self.assertEqual(len(threads), 2)
+        self.assertFalse(threading.main_thread() in threads)
+
+    def test_malformed_frames(self):
+        answers = asyncio.run(self.run_clients([[self.spend(1)[:-10], self.spend(0)]]))
+        self.assertEqual([accepted for accepted, error in answers[0]], [False, True])
+        self.assertTrue(answers[0][0][1].startswith("ValueError"))
+
+        async def send(data, eof):
+            reader, writer = await asyncio.open_unix_connection(self.path)
+            writer.write(data)
+            if eof:
+                writer.write_eof()
+            answers = []
+            while True:
+                answer = await read_frame(reader)
+                if answer is None:
+                    break
+                answers.append(answer[:1])
+            writer.close()
+            return answers
+
+        async def submit():
+            frame = FRAME.pack(len(self.spend(2))) + self.spend(2)
+            return [await send(frame + FRAME.pack(MAX_FRAME + 1), False),
+                    await send(FRAME.pack(len(self.spend(3))) + self.spend(3)[:-1], True),
+                    await send(frame[:2], True)]
+        # The connection is answered up to the bad frame, and then closed.
+        self.assertEqual(asyncio.run(self.serving(submit)), [[REJECTED, REJECTED], [REJECTED], [REJECTED]])
+
+        async def submit_too_large():
+            c = await Client.connect(self.path)
+            try:
+                with self.assertRaises(ConnectionError):
+                    await c.submit_many([b"\x00" * (MAX_FRAME + 1), self.spend(4)])
+            finally:
+                c.close()
+        asyncio.run(self.serving(submit_too_large))
+
+    @unittest.skipIf(mimblewimble_chain is None, "needs toycrypto")
+    def test_mimblewimble(self):
+        mw = mimblewimble_chain
+        genesis = mw.OwnedOutput.generate(1000)
+        self.chain = mw.Chain(genesis.blind())
+        satoshi = mw.Actor([genesis], self.chain)
+        clemens = mw.Actor([], self.chain)
+        data = clemens.receive(satoshi.send(100)).serialize()
+        x = 1
+        while pow(x ** 3 + 7, (mw.p - 1) // 2, mw.p) == 1:
+            x += 1
+        bad = data[:8] + b"\x02" + mw.encode_int(x) + data[8 + 33:]
+        self.service = Service(self.chain, decode_mimblewimble, max_delay=0.05)
+        answers = asyncio.run(self.run_clients([[bad, data, data]]))
+        self.assertEqual([accepted for accepted, error in answers[0]], [False, True, False])
+        self.assertTrue(answers[0][0][1].startswith("ValueError"))
+        self.assertEqual(clemens.coins_owned(), 100)
+
+
+if __name__ == '__main__':
+    unittest.main()